@@ -16,42 +16,42 @@ Main entry point for deepsea-ai
 
 from datetime import datetime
 
-import boto3
 import click
 import shutil
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from urllib.parse import urlparse
 
 from deepsea_ai.config.config import Config
-from deepsea_ai.commands import upload_tag, process, train, bucket, monitor
+from deepsea_ai.commands.train import models
 from deepsea_ai.config import config as cfg
-from deepsea_ai.config import setup
-from deepsea_ai.database import api, queries
 from deepsea_ai import logger
 from deepsea_ai.logger import info, err, debug, warn, critical
 from deepsea_ai import __version__
+from deepsea_ai.aws import clients
+from deepsea_ai.aws.s3url import s3url
 from deepsea_ai.logger.job_cache import JobCache
+from deepsea_ai.logger import query_cache
 
 default_config = cfg.Config(quiet=True)
 default_config_ini = cfg.default_config_ini
 
 
+# the command modules pull in sagemaker, boto3 resources, etc. so they are imported inside the command that needs
+# them to keep --help and argument errors fast
+
 def init(log_prefix: str = "deepsea_ai", config: str = default_config_ini) -> Config:
     python_path = Path('logs')
     logger.create_logger_file(python_path, log_prefix)
 
-    # get the AWS profile from the environment and use it for all AWS commands
-    if 'AWS_DEFAULT_PROFILE' in os.environ or 'AWS_PROFILE' in os.environ:
-        if 'AWS_DEFAULT_PROFILE' in os.environ:
-            info(
-                f'AWS_DEFAULT_PROFILE is set to {os.environ["AWS_DEFAULT_PROFILE"]} and will be used for all AWS commands')
-            profile = os.environ['AWS_DEFAULT_PROFILE']
-            boto3.setup_default_session(profile_name=profile)
-        if 'AWS_PROFILE' in os.environ:
-            info(f'AWS_PROFILE is set to {os.environ["AWS_PROFILE"]} and will be used for all AWS commands')
-            profile = os.environ['AWS_PROFILE']
-            boto3.setup_default_session(profile_name=profile)
+    # get the AWS profile from the environment and use it for all AWS commands; AWS_PROFILE wins if both are set
+    for env in ('AWS_PROFILE', 'AWS_DEFAULT_PROFILE'):
+        if env in os.environ:
+            profile = os.environ[env]
+            info(f'{env} is set to {profile} and will be used for all AWS commands')
+            clients.use_profile(profile)
+            break
 
     # initialize the config file either from the default or a custom location
     if config:
@@ -68,13 +68,30 @@ def init(log_prefix: str = "deepsea_ai", config: str = default_config_ini) -> Co
     return custom_config
 
 
-user_name = default_config.get_username()
+def get_loaded_media(database, processing_job_name: str) -> set:
+    """
+    Get the names of all media already processed and loaded into the database for a processing job
+    :param database: The deepsea-ai GraphQL client
+    :param processing_job_name: The name of the processing job, e.g. <processor>-<job>
+    :return: Set of media names, or None if the query is not supported by the endpoint
+    """
+    from deepsea_ai.database import api, queries
+
+    try:
+        medias = database.execute(queries.GET_ALL_MEDIA_IN_JOB, processing_job_name=processing_job_name)
+        loaded = {m['name'] for m in medias['data']['allMediaInJob']}
+    except (api.GraphQLError, KeyError, TypeError) as e:
+        warn(f'Unable to fetch all media in job {processing_job_name}: {e}. Checking each video instead')
+        return None
+    info(f'Found {len(loaded)} videos already processed and loaded for {processing_job_name}')
+    return loaded
 
-# example s3 buckets for help
-example_input_process_s3 = f's3://{user_name}-video-in-dev'
-example_output_process_s3 = f's3://{user_name}-tracks-out-dev'
-example_input_train_s3 = f's3://{user_name}-training-dev'
-example_output_train_s3 = f's3://{user_name}-model-checkpoints-dev'
+
+# example s3 buckets for help; the user is a placeholder so --help does not need AWS credentials or a call to STS
+example_input_process_s3 = 's3://<user>-video-in-dev'
+example_output_process_s3 = 's3://<user>-tracks-out-dev'
+example_input_train_s3 = 's3://<user>-training-dev'
+example_output_train_s3 = 's3://<user>-model-checkpoints-dev'
 
 
 @click.group(context_settings={'help_option_names': ['-h', '--help']})
@@ -99,14 +116,15 @@ def setup_command(config, mirror):
     """
      Setup your AWS environment. Only need to run this once unless running in a new AWS account.
     """
-    init(log_prefix="deepsea_ai_setup")
-    custom_config = cfg.Config(config)
+    from deepsea_ai.config import setup
+
+    custom_config = init(log_prefix="deepsea_ai_setup", config=config)
     account = custom_config.get_account()
     region = custom_config.get_region()
     image_cfg = ['yolov5_ecr', 'deepsort_ecr', 'strongsort_ecr']
     image_tags = [custom_config('aws', t) for t in image_cfg]
     if mirror:
-        setup.mirror_docker_hub_images_to_ecr(ecr_client=boto3.client("ecr"), account_id=account,
+        setup.mirror_docker_hub_images_to_ecr(ecr_client=clients.ecr_client(), account_id=account,
                                               region=region, image_tags=image_tags)
     setup.create_role(account_id=account)
     setup.store_role(default_config)
@@ -140,52 +158,105 @@ def setup_command(config, mirror):
 @click.option('--conf-thres', type=click.FLOAT, default=.01, help='Confidence threshold for the model')
 @click.option('--iou-thres', type=click.FLOAT, default=.1, help='IOU threshold for the model')
 @click.option('--dry-run', is_flag=True, default=False, help='Run the command without actually submitting the job.')
-def batchprocess_command(config, check, upload, clean, cluster, job, input, exclude, conf_thres, iou_thres, dry_run):
+@click.option('--cache-ttl', type=int, default=query_cache.default_ttl,
+              help='Seconds to reuse the result of --check from a previous run of the same job. Set to 0 to disable.')
+def batchprocess_command(config, check, upload, clean, cluster, job, input, exclude, conf_thres, iou_thres, dry_run,
+                         cache_ttl):
     """
      (optional) upload, then batch process in an ECS cluster
     """
+    from deepsea_ai.commands import upload_tag, process
+    from deepsea_ai.database import api, queries
+
     custom_config = init(log_prefix="deepsea_ai_ecsprocess", config=config)
-    database = None
-    if check:
-        warn('Checking if video has been processed and loaded before sending off a job.'
-             ' Requires a deepsea-ai GraphQL endpoint')
-        database = api.DeepSeaAIClient(custom_config('database', 'gql'))
 
     input_path = Path(input)
     resources = custom_config.get_resources(cluster)
     user_name = custom_config.get_username()
     videos = custom_config.check_videos(input_path, exclude)
     tags = custom_config.get_tags(f'Video uploaded from {input} by user {user_name} ')
+    processing_job_name = f"{resources['PROCESSOR']}-{job}"
 
-    total_submitted = 0
-    for v in videos:
-        loaded = False
-        if database:
+    # fetch everything already loaded for this job in one query; None if the endpoint does not support it
+    loaded_media = None
+    if check:
+        warn('Checking if video has been processed and loaded before sending off a job.'
+             ' Requires a deepsea-ai GraphQL endpoint')
+        loaded_media = query_cache.get(processing_job_name, cache_ttl)
+        if loaded_media is None:
+            loaded_media = get_loaded_media(api.DeepSeaAIClient(custom_config('database', 'gql')), processing_job_name)
+            if loaded_media is not None:
+                query_cache.put(processing_job_name, loaded_media)
+
+    # the GraphQL client session is not thread safe, so each worker gets its own
+    local = threading.local()
+
+    def _process_one(v: Path) -> (Path, bool):
+        if not hasattr(local, 'database'):
+            local.database = api.DeepSeaAIClient(custom_config('database', 'gql')) \
+                if check and loaded_media is None else None
+
+        if loaded_media is not None:
+            if v.name in loaded_media:
+                info(f'Video {v.name} has already been processed and loaded...skipping')
+                return v, False
+        elif local.database:
             info(f'Checking if {v.name} has already been processed and loaded into the database...')
             # Check if the video has already been loaded by looking it up by the media name per this job name
-            medias = database.execute(queries.GET_MEDIA_IN_JOB,
-                                      processing_job_name=f"{resources['PROCESSOR']}-{job}",
-                                      media_name=v.name)
+            medias = local.database.execute(queries.GET_MEDIA_IN_JOB,
+                                            processing_job_name=processing_job_name,
+                                            media_name=v.name)
 
             # Found a media in the job as keyed by the processing name, so assume that this was already processed
             if len(medias['data']['mediaInJob']) > 0:
                 info(f'Video {v.name} has already been processed and loaded...skipping')
-                loaded = True
+                return v, False
 
-        if upload and not loaded:
+        if upload:
             if dry_run:
                 info(f'Dry run: Uploading {v.name} to S3 bucket {resources["VIDEO_BUCKET"]}')
             else:
-                upload_tag.video_data([v], urlparse(f's3://{resources["VIDEO_BUCKET"]}'), tags)
+                upload_tag.video_data([v], s3url(f's3://{resources["VIDEO_BUCKET"]}'), tags)
 
-        if not loaded:
-            if dry_run:
-                info(f'Dry run: Submitting {v.name} to {resources["PROCESSOR"]} for processing')
-            else:
-                process.batch_run(resources, v, job, user_name, clean, conf_thres, iou_thres)
-            total_submitted += 1
-        else:
-            warn(f'Video {v.name} has already been processed and loaded...skipping')
+        return v, True
+
+    # submit the videos ready to process in batches as the workers finish with them
+    submitted_media = []
+    pending = []
+
+    def _submit():
+        process.batch_run_bulk(resources, pending, job, user_name, clean, conf_thres, iou_thres)
+        submitted_media.extend(p.name for p in pending)
+        pending.clear()
+
+    try:
+        # each worker uploads one video, so use as many as the client connection pool is sized for
+        with ThreadPoolExecutor(max_workers=clients.upload_workers) as executor:
+            futures = [executor.submit(_process_one, v) for v in videos]
+            try:
+                for future in as_completed(futures):
+                    v, submit = future.result()
+                    if not submit:
+                        warn(f'Video {v.name} has already been processed and loaded...skipping')
+                    elif dry_run:
+                        info(f'Dry run: Submitting {v.name} to {resources["PROCESSOR"]} for processing')
+                        submitted_media.append(v.name)
+                    else:
+                        pending.append(v)
+                        if len(pending) == process.max_batch_size:
+                            _submit()
+            except Exception:
+                # stop at the first failure; only the videos already being uploaded are waited on
+                for f in futures:
+                    f.cancel()
+                raise
+    finally:
+        # queue the videos that are ready even if another failed, and remember them so a repeat run skips them
+        if pending:
+            _submit()
+        if loaded_media is not None and not dry_run:
+            query_cache.append(processing_job_name, submitted_media)
+    total_submitted = len(submitted_media)
 
     info(f'==== Submitted {total_submitted} videos to {resources["PROCESSOR"]} for processing =====')
 
@@ -219,34 +290,45 @@ def batchprocess_command(config, check, upload, clean, cluster, job, input, excl
               help='Set option to output original video with detection boxes overlaid.')
 @click.option('--instance-type', type=str, default='ml.g4dn.xlarge',
               help='AWS instance type, e.g. ml.g4dn.xlarge, ml.c5.xlarge')
+@click.option('--dry-run', is_flag=True, default=False, help='Run the command without actually submitting the job.')
 def process_command(config, tracker, input, exclude, input_s3, output_s3, model_s3, config_s3, model_size,
                     reid_model_url,
-                    conf_thres, iou_thres, save_vid, job_description, instance_type):
+                    conf_thres, iou_thres, save_vid, job_description, instance_type, dry_run):
     """
      upload video(s) then process with a model
     """
+    from deepsea_ai.commands import upload_tag, process, bucket
+
     custom_config = init(log_prefix="deepsea_ai_process", config=config)
 
     # get tags to apply to the resources for cost monitoring
     tags = custom_config.get_tags(job_description)
 
     input_path = Path(input)
-    input_s3 = urlparse(input_s3.rstrip('/'))
-    output_s3 = urlparse(output_s3.rstrip('/'))
-    model_s3 = urlparse(model_s3.rstrip('/'))
-
-    # create the buckets
-    info(f'Creating buckets')
-
-    if bucket.create(input_s3, tags) and bucket.create(output_s3, tags):
+    input_s3 = s3url(input_s3)
+    output_s3 = s3url(output_s3)
+    model_s3 = s3url(model_s3)
 
+    if dry_run:
         videos = custom_config.check_videos(input_path, exclude)
-        input_s3, size_gb = upload_tag.video_data(videos, input_s3, tags)
-
+        info(f'Dry run: Creating buckets {input_s3.netloc} and {output_s3.netloc}')
+        info(f'Dry run: Uploading {len(videos)} videos to {input_s3.url()}')
+        input_s3 = upload_tag.video_folder(videos, input_s3)
+        size_gb = max(round(sum(v.stat().st_size for v in videos) / 1e9), 1)
+        ready = True
+    else:
+        # create the buckets
+        info(f'Creating buckets')
+        ready = bucket.create(input_s3, tags) and bucket.create(output_s3, tags)
+        if ready:
+            videos = custom_config.check_videos(input_path, exclude)
+            input_s3, size_gb = upload_tag.video_data(videos, input_s3, tags)
+
+    if ready:
         # insert the datetime prefix to make a unique key for the output
         now = datetime.utcnow()
         prefix = now.strftime("%Y%m%dT%H%M%SZ")
-        output_unique_s3 = urlparse(f"s3://{output_s3.netloc}/{output_s3.path.lstrip('/')}/{prefix}/")
+        output_unique_s3 = s3url(f"{output_s3.url()}/{prefix}/")
 
         # estimate the volume size needed for the job; make it 2x the size of the input if saving the video
         if save_vid:
@@ -256,7 +338,7 @@ def process_command(config, tracker, input, exclude, input_s3, output_s3, model_
 
         process.script_processor_run(input_s3, output_unique_s3, model_s3, model_size, reid_model_url,
                                      volume_size_gb, instance_type, config_s3, save_vid, conf_thres,
-                                     iou_thres, tracker, custom_config, tags)
+                                     iou_thres, tracker, custom_config, tags, dry_run)
 
 
 @cli.command(name="upload")
@@ -270,8 +352,10 @@ def upload_command(config, input, s3):
     """
     Upload videos
     """
+    from deepsea_ai.commands import upload_tag, bucket
+
     custom_config = init(log_prefix="deepsea_ai_upload", config=config)
-    input_s3 = urlparse(s3.rstrip('/'))
+    input_s3 = s3url(s3)
     tags = custom_config.get_tags(f'Uploaded {input} to {s3}')
     bucket.create(input_s3, tags)
     videos = custom_config.check_videos(Path(input))
@@ -298,7 +382,7 @@ def upload_command(config, input, s3):
 @click.option('--output-s3', type=str, required=True,
               help=f'Path to the s3 bucket to store the output, e.g. {example_output_train_s3} or {example_output_train_s3}')
 @click.option('--resume', type=bool, default=False, help="Resume training from previous run")
-@click.option('--model', type=str, default='yolov5x', help=f"Model choice: {','.join(train.models)} ")
+@click.option('--model', type=str, default='yolov5x', help=f"Model choice: {','.join(models)} ")
 @click.option('--epochs', type=int, default=2, help='Number of epochs. Default 2.')
 @click.option('--batch-size', type=int, default=2, help='Batch size. Default 2.')
 @click.option('--instance-type', type=str, default='ml.p3.2xlarge',
@@ -308,6 +392,8 @@ def train_command(config, images, labels, label_map, input_s3, output_s3, resume
     """
      (optional) upload training data, then train a YOLOv5 model
     """
+    from deepsea_ai.commands import upload_tag, train, bucket
+
     custom_config = init(log_prefix="deepsea_ai_train", config=config)
 
     if instance_type == 'ml.p2.xlarge':
@@ -322,8 +408,8 @@ def train_command(config, images, labels, label_map, input_s3, output_s3, resume
     name_path = Path(label_map)
 
     # strip off any training forward slashes
-    input_s3 = urlparse(input_s3.rstrip('/'))
-    output_s3 = urlparse(output_s3.rstrip('/'))
+    input_s3 = s3url(input_s3)
+    output_s3 = s3url(output_s3)
 
     data = [image_path, label_path, name_path]
 
@@ -343,10 +429,10 @@ def train_command(config, images, labels, label_map, input_s3, output_s3, resume
         prefix = now.strftime("%Y%m%dT%H%M%SZ")
 
         if resume:  # resuming from previous bucket, so no need to set prefix
-            ckpts_s3 = urlparse(f"s3://{output_s3.netloc}/{output_s3.path.lstrip('/')}")
+            ckpts_s3 = output_s3
         else:
-            ckpts_s3 = urlparse(f"s3://{output_s3.netloc}/{output_s3.path.lstrip('/')}/{prefix}/checkpoints/")
-        model_s3 = urlparse(f"s3://{output_s3.netloc}/{output_s3.path.lstrip('/')}/{prefix}/models/")
+            ckpts_s3 = s3url(f"{output_s3.url()}/{prefix}/checkpoints/")
+        model_s3 = s3url(f"{output_s3.url()}/{prefix}/models/")
 
         # train
         train.yolov5(data, input_training, ckpts_s3, model_s3, epochs, batch_size, volume_size_gb, model, instance_type,
@@ -363,8 +449,10 @@ def package_command(s3):
     This is done at the end of the train command automatically and stored in a model.tar.gz file.
     This is added in case checkpoints were generated outside the deepsea-ai-traing command, e.g. SageMaker Studio. Colab
     """
+    from deepsea_ai.commands import train
+
     init(log_prefix="deepsea_ai_package")
-    train.package(urlparse(s3.rstrip('/')))
+    train.package(s3url(s3))
 
 
 @cli.command(name="split")
@@ -376,6 +464,8 @@ def split_command(input: str, output: str):
     """
     Split data into train/val/test sets randomly per the following percentages 85%/10%/5%
     """
+    from deepsea_ai.commands import train
+
     init(log_prefix="deepsea_ai_split")
     input_path = Path(input)
     output_path = Path(output)
@@ -408,6 +498,8 @@ def monitor_command(cluster: str, config, job: str, update_period: int):
     """
     Print monitoring information for the cluster
     """
+    from deepsea_ai.commands import monitor
+
     custom_config = init(log_prefix="deepsea_ai_monitor", config=config)
     resources = custom_config.get_resources(cluster)
     if resources:
@@ -0,0 +1 @@
+from . import clients, s3url
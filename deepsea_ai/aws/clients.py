@@ -0,0 +1,149 @@
+# !/usr/bin/env python
+__author__ = "Danelle Cline"
+__copyright__ = "Copyright 2023, MBARI"
+__credits__ = ["MBARI"]
+__license__ = "GPL"
+__maintainer__ = "Danelle Cline"
+__email__ = "dcline at mbari.org"
+__doc__ = '''
+
+Shared AWS session and clients. Building a client loads the service model and creates a new connection pool,
+so these are created once per process and reused by all the commands. boto3 takes a while to import, so it is only
+loaded when the first client is made, keeping --help fast.
+
+@author: __author__
+@status: __status__
+@license: __license__
+'''
+
+import functools
+import threading
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import boto3
+    from boto3.s3.transfer import TransferConfig
+
+# up to upload_workers files are uploaded at once, each with transfer_concurrency threads, so size the pool for all
+# of them to never wait on a connection; the pool only opens connections as they are needed
+upload_workers = 16
+transfer_concurrency = 16
+
+# sessions are not thread safe, so creating clients or resources from the shared session is serialized
+_lock = threading.Lock()
+_local = threading.local()
+
+
+@functools.lru_cache(maxsize=1)
+def client_config():
+    from botocore.config import Config
+    return Config(max_pool_connections=upload_workers * transfer_concurrency,
+                  retries={'mode': 'adaptive', 'max_attempts': 8},
+                  tcp_keepalive=True)
+
+
+def session() -> 'boto3.session.Session':
+    """
+    Get the session shared by all the clients. It is boto3's default session, so sagemaker and anything else using
+    boto3 directly run with the same profile
+    """
+    import boto3
+    if boto3.DEFAULT_SESSION is None:
+        boto3.setup_default_session()
+    return boto3.DEFAULT_SESSION
+
+
+def use_profile(profile_name: str):
+    """
+    Set up the shared session with an AWS profile, dropping any clients already created with another one
+    :param profile_name: Name of the profile in the AWS config
+    """
+    import boto3
+    global _local
+    with _lock:
+        boto3.setup_default_session(profile_name=profile_name)
+        for f in (s3_client, ecr_client, cloudformation_client, ecs_client, sts_client, autoscaling_client,
+                  sqs_client, iam_client, caller_identity):
+            f.cache_clear()
+        _local = threading.local()
+
+
+def _client(service_name: str):
+    with _lock:
+        return session().client(service_name, config=client_config())
+
+
+def _resource(service_name: str):
+    # resources are not thread safe, so each thread gets its own
+    resource = getattr(_local, service_name, None)
+    if resource is None:
+        with _lock:
+            resource = session().resource(service_name, config=client_config())
+        setattr(_local, service_name, resource)
+    return resource
+
+
+@functools.lru_cache(maxsize=1)
+def s3_client():
+    return _client('s3')
+
+
+@functools.lru_cache(maxsize=1)
+def ecr_client():
+    return _client('ecr')
+
+
+@functools.lru_cache(maxsize=1)
+def cloudformation_client():
+    return _client('cloudformation')
+
+
+@functools.lru_cache(maxsize=1)
+def ecs_client():
+    return _client('ecs')
+
+
+@functools.lru_cache(maxsize=1)
+def sts_client():
+    return _client('sts')
+
+
+@functools.lru_cache(maxsize=1)
+def autoscaling_client():
+    return _client('autoscaling')
+
+
+@functools.lru_cache(maxsize=1)
+def sqs_client():
+    return _client('sqs')
+
+
+@functools.lru_cache(maxsize=1)
+def iam_client():
+    return _client('iam')
+
+
+@functools.lru_cache(maxsize=1)
+def caller_identity() -> dict:
+    """
+    Get the account and user of the credentials in use; they do not change while running, so STS is asked only once
+    """
+    return sts_client().get_caller_identity()
+
+
+@functools.lru_cache(maxsize=1)
+def transfer_config() -> 'TransferConfig':
+    """
+    Transfer settings for uploading videos; they are large, so use bigger parts and more threads than the defaults
+    """
+    from boto3.s3.transfer import TransferConfig
+    return TransferConfig(multipart_threshold=64 * 1024 * 1024, multipart_chunksize=64 * 1024 * 1024,
+                          max_concurrency=transfer_concurrency, use_threads=True)
+
+
+def s3_resource():
+    return _resource('s3')
+
+
+def sqs_resource():
+    return _resource('sqs')
@@ -0,0 +1,44 @@
+# !/usr/bin/env python
+__author__ = "Danelle Cline"
+__copyright__ = "Copyright 2023, MBARI"
+__credits__ = ["MBARI"]
+__license__ = "GPL"
+__maintainer__ = "Danelle Cline"
+__email__ = "dcline at mbari.org"
+__doc__ = '''
+
+Parsed s3 locations, e.g. s3://902005-video-in-dev/Dive1423
+
+@author: __author__
+@status: __status__
+@license: __license__
+'''
+
+from dataclasses import dataclass
+from urllib.parse import urlparse
+
+
+@dataclass(frozen=True)
+class S3Url:
+    netloc: str
+    key: str  # no leading forward slash
+
+    @property
+    def path(self) -> str:
+        """
+        The key as a urlparse path, i.e. with a leading forward slash, for code that takes a urlparse tuple
+        """
+        return f'/{self.key}' if self.key else ''
+
+    def url(self) -> str:
+        return f"s3://{self.netloc}/{self.key}"
+
+
+def s3url(s: str) -> S3Url:
+    """
+    Parse an s3 url, stripping any trailing forward slashes
+    :param s: The url, e.g. s3://902005-video-in-dev/Dive1423/
+    :return: The parsed url
+    """
+    p = urlparse(s.rstrip('/'))
+    return S3Url(p.netloc, p.path.lstrip('/'))
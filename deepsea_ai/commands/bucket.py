@@ -15,11 +15,13 @@ Bucket utilities
 '''
 
 import logging
-import boto3
-import numpy as np
 from botocore.exceptions import ClientError
+from deepsea_ai.aws import clients
 from deepsea_ai.logger import info
 
+# buckets created or found in this process, keyed by (netloc, path)
+_created = set()
+
 
 def create(bucket: tuple, tags: dict):
     """Create an S3 bucket
@@ -27,28 +29,43 @@ def create(bucket: tuple, tags: dict):
     :param tags: Tags to assign to the bucket
     :return: True if bucket created, or it already exists, else False
     """
+    if (bucket.netloc, bucket.path) in _created:
+        return True
+
+    s3_client = clients.s3_client()
+
+    # skip the create if the bucket is already there
+    try:
+        s3_client.head_bucket(Bucket=bucket.netloc)
+        info(f'Found bucket {bucket.netloc}')
+        _created.add((bucket.netloc, bucket.path))
+        return True
+    except ClientError as e:
+        # anything but a missing bucket, e.g. forbidden, is resolved by the create below
+        logging.debug(e)
 
     # Create bucket
     try:
         info(f'Creating bucket {bucket.netloc}...')
-        session = boto3.session.Session()
-        s3_client = boto3.client('s3', region_name=session.region_name)
-        location = {'LocationConstraint': session.region_name}
+        region_name = clients.session().region_name
+        location = {'LocationConstraint': region_name}
         s3_client.create_bucket(Bucket=bucket.netloc,
                                 CreateBucketConfiguration=location)
 
         try:
             s3_client.put_bucket_tagging(Bucket=bucket.netloc, Tagging={'TagSet': tags})
         except Exception as error:
-            raise f'Error creating bucket {bucket.netloc} {error}'
+            raise Exception(f'Error creating bucket {bucket.netloc} {error}')
     except ClientError as e:
         code = e.response['Error']['Code']
         if code == "BucketAlreadyOwnedByYou" or code == 'BucketAlreadyExists':
             logging.info(e)
+            _created.add((bucket.netloc, bucket.path))
             return True
 
         logging.error(e)
         return False
+    _created.add((bucket.netloc, bucket.path))
     return True
 
 
@@ -59,12 +76,11 @@ def size(bucket: tuple) -> int:
     :return: Total size in gigabytes
     """
     size_gb = 0
-    session = boto3.session.Session()
-    s3 = session.resource('s3')
-    b = s3.Bucket(bucket.netloc)
+    b = clients.s3_resource().Bucket(bucket.netloc)
 
-    for object in b.objects.filter(Prefix=bucket.path.split('/')[-1]):
-        object.key.split('/')[0]
+    # list under the folder so sibling prefixes, e.g. Dive10 for Dive1, are not counted
+    folder = bucket.path.strip('/')
+    for object in b.objects.filter(Prefix=f'{folder}/' if folder else ''):
         size_gb += object.size
 
-    return max(np.round(size_gb / 1e9), 1)
+    return max(round(size_gb / 1e9), 1)
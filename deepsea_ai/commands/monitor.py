@@ -20,9 +20,9 @@ from datetime import datetime
 from pathlib import Path
 from threading import Thread
 
-import boto3
 from botocore.exceptions import ClientError
 
+from deepsea_ai.aws import clients
 from deepsea_ai.logger import info, warn, debug, exception, err
 from deepsea_ai.logger.job_cache import JobStatus, JobCache
 
@@ -35,7 +35,7 @@ def log_scaling_activities(resources: dict, num_records: int = 10) -> int:
     :param report: If true, log the activities
     :return: Number of activities
     """
-    client = boto3.client('autoscaling')
+    client = clients.autoscaling_client()
     response = client.describe_scaling_activities(
         ActivityIds=[],
         AutoScalingGroupName=resources['ASG'],
@@ -75,7 +75,7 @@ def log_queue_status(resources: dict) -> dict:
     :param resources: Dictionary of resources
     :return: Dictionary of the number of messages in each queue
     """
-    client = boto3.client('sqs')
+    client = clients.sqs_client()
     queues = ['TRACK_QUEUE', 'VIDEO_QUEUE', 'DEAD_QUEUE']
     processor = resources['PROCESSOR']
     num_messages_visible = {}
@@ -87,7 +87,7 @@ def log_queue_status(resources: dict) -> dict:
                 AttributeNames=['ApproximateNumberOfMessages', 'ApproximateNumberOfMessagesNotVisible'])
             num_messages_visible[q] = response['Attributes']['ApproximateNumberOfMessages']
             num_messages_invisible[q] = response['Attributes']['ApproximateNumberOfMessagesNotVisible']
-            sqs = boto3.resource('sqs')
+            sqs = clients.sqs_resource()
             queue = sqs.Queue(resources[q])
             if q == 'TRACK_QUEUE':
                 info(
@@ -168,7 +168,7 @@ def receive_messages(queue, max_number, wait_time):
             WaitTimeSeconds=wait_time
         )
         for msg in messages:
-            debug(f"Received message: {msg.message_id}: {msg.body}")
+            debug("Received message: %s: %s", msg.message_id, msg.body)
     except ClientError as error:
         exception(f"Couldn't receive messages from queue: {queue}")
         raise error
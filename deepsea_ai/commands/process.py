@@ -16,29 +16,56 @@ Process a collection of videos; assumes videos have previously been uploaded wit
 
 import os
 import inspect
-import boto3
 import json
+import uuid
 from datetime import datetime
 from pathlib import Path
+from typing import List
 
+from botocore.exceptions import ClientError
+
+from deepsea_ai.aws import clients
+from deepsea_ai.aws.s3url import S3Url, s3url
 from deepsea_ai.config import config as cfg
 from deepsea_ai.commands.upload_tag import get_prefix
 from deepsea_ai.logger import debug, info, err, warn, exception, keys
-from deepsea_ai.logger.job_cache import JobStatus, JobCache
+from deepsea_ai.logger import job_cache
+from deepsea_ai.logger.job_cache import JobStatus
+
+# orjson is optional; it is several times faster than json for the queue messages
+try:
+    import orjson
 
-from sagemaker.processing import ScriptProcessor, ProcessingInput, ProcessingOutput
+    def _dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+except ImportError:
+    def _dumps(obj) -> str:
+        return json.dumps(obj, separators=(',', ':'))
 
 code_path = Path(os.path.abspath(inspect.getfile(inspect.currentframe())))
 
-def script_processor_run(input_s3: tuple, output_s3: tuple, model_s3: tuple, model_size: int,
+# config options in the [aws] section with the default track config and the docker image for each supported tracker
+tracker_config_s3 = {'deepsort': 'deepsort_track_config_s3', 'strongsort': 'strongsort_track_config_s3'}
+tracker_ecr = {'deepsort': 'deepsort_ecr', 'strongsort': 'strongsort_ecr'}
+
+
+def script_processor_run(input_s3: S3Url, output_s3: S3Url, model_s3: S3Url, model_size: int,
                          reid_model_url:str, volume_size_gb:int, instance_type:str,
                          config_s3: str, save_vid: bool, conf_thres: float, iou_thres: float,
-                         tracker:str, custom_config:cfg.Config, tags:dict):
+                         tracker:str, custom_config:cfg.Config, tags:dict, dry_run: bool = False):
     """
     Process a collection of videos with the ScriptProcessor
+    :param dry_run: Log the arguments for the processor and return without submitting the job
     """
     user_name = custom_config.get_username()
-    if tracker not in ['deepsort', 'strongsort']:
+    # list under the folder so the keys strip to paths relative to it and sibling prefixes, e.g. Dive10 for Dive1,
+    # are not picked up
+    prefix = f"{input_s3.key.rstrip('/')}/" if input_s3.key else ''
+    plen = len(prefix)
+    input_url = input_s3.url()
+    output_url = output_s3.url()
+    model_url = model_s3.url()
+    if tracker not in tracker_config_s3:
         exception(f'{tracker} not currently supported')
         raise Exception(f'{tracker} not currently supported')
 
@@ -47,27 +74,30 @@ def script_processor_run(input_s3: tuple, output_s3: tuple, model_s3: tuple, mod
                  f'--conf-thres={conf_thres}',
                  f'--iou-thres={iou_thres}',
                  f'--model-size={model_size}',
-                 f"--model-s3=s3://{model_s3.netloc}/{model_s3.path.lstrip('/')}",
+                 f"--model-s3={model_url}",
                  ]
     if config_s3:
         arguments.append(f'--config-s3={config_s3}')
     if reid_model_url and tracker == 'strongsort': # only support with strongsort as of 11-18-2022
         arguments.append(f'--reid-weights={reid_model_url}')
-    else:
-        if tracker == 'deepsort':
-            arguments.append(f"--config-s3={custom_config('aws','deepsort_track_config_s3')}")
-        if tracker == 'strongsort':
-            arguments.append(f"--config-s3={custom_config('aws','strongsort_track_config_s3')}")
+    elif not config_s3:
+        arguments.append(f"--config-s3={custom_config('aws', tracker_config_s3[tracker])}")
     if save_vid:
         arguments.append('--save-vid')
-    debug(arguments)
+    debug('Script processor arguments: %s', arguments)
+
+    if dry_run:
+        info(f'Dry run: Processing {input_url} with {tracker} and arguments {arguments}')
+        return
+
+    # sagemaker is slow to import so only load it when submitting a job
+    from sagemaker.processing import ScriptProcessor, ProcessingInput, ProcessingOutput
 
     # Construct the uri from the config, e.g.
     # mbari/deepsea-yolov5:1.1.2 => 872338704006.dkr.ecr.us-west-2.amazonaws.com/deepsea-yolov5:1.1.2
     account = custom_config.get_account()
     region = custom_config.get_region()
-    image_uri_docker = {'deepsort':  custom_config('aws', 'deepsort_ecr'), 'strongsort': custom_config('aws', 'strongsort_ecr')}
-    image_uri_ecr = f"{account}.dkr.ecr.{region}.amazonaws.com/{image_uri_docker[tracker]}"
+    image_uri_ecr = f"{account}.dkr.ecr.{region}.amazonaws.com/{custom_config('aws', tracker_ecr[tracker])}"
 
     base_job_name = f'{tracker}-yolov5-{user_name}'
     script_processor = ScriptProcessor(command=['python3'],
@@ -81,48 +111,148 @@ def script_processor_run(input_s3: tuple, output_s3: tuple, model_s3: tuple, mod
                                        tags=tags)
 
     # log it
-    info(f"Start script processor for inputs s3://{input_s3.netloc}/{input_s3.path.lstrip('/')}")
+    info("Start script processor for inputs %s", input_url)
 
-    # get a list of videos in the input bucket
-    s3 = boto3.resource('s3')
-    bucket = s3.Bucket(input_s3.netloc)
-    videos = [obj.key for obj in bucket.objects.filter(Prefix=input_s3.path.lstrip('/'))]
-    debug(videos)
-    # strip off the prefix
-    videos = [video.replace(input_s3.path.lstrip('/'), '') for video in videos]
+    # get a list of videos in the input bucket with the prefix sliced off as each page arrives; StartAfter skips the
+    # folder marker and anything that is not a video, e.g. logs or sidecar json, is left out
+    paginator = clients.s3_client().get_paginator('list_objects_v2')
+    pages = paginator.paginate(Bucket=input_s3.netloc, Prefix=prefix, StartAfter=prefix,
+                               PaginationConfig={'PageSize': 1000})
+    videos = [obj['Key'][plen:] for page in pages for obj in page.get('Contents', [])
+              if obj['Key'].lower().endswith(cfg.video_formats)]
+    debug('Videos in %s: %s', input_url, videos)
 
     # log the video as running; the processor is the docker image
     processor = image_uri_ecr.split('/')[-1]
-    JobCache().set_job(base_job_name, processor, videos, JobStatus.RUNNING)
-    for v in videos:
-        JobCache().set_media(base_job_name, v, JobStatus.RUNNING)
-
-    script_processor.run(code=f'{code_path.parent.parent.parent}/deepsea_ai/pipeline/run_{tracker}.py',
-                         arguments=arguments,
-                         inputs=[ProcessingInput(
-                             source=f"s3://{input_s3.netloc}/{input_s3.path.lstrip('/')}",
-                             destination='/opt/ml/processing/input')],
-                         outputs=[ProcessingOutput(source='/opt/ml/processing/output',
-                                                   destination=f"s3://{output_s3.netloc}/{output_s3.path.lstrip('/')}")]
-                         )
+    # the cache writes go to a background thread so the job is submitted without waiting on the disk
+    job_cache.defer('set_job_bulk', base_job_name, processor, videos, JobStatus.RUNNING)
+
+    # pass the videos already listed to the processor in a manifest so it does not list the prefix again
+    if videos:
+        source, s3_data_type = write_manifest(input_s3.netloc, prefix, videos), 'ManifestFile'
+    else:
+        source, s3_data_type = input_url, 'S3Prefix'
+
+    run_error = None
+    try:
+        script_processor.run(code=f'{code_path.parent.parent.parent}/deepsea_ai/pipeline/run_{tracker}.py',
+                             arguments=arguments,
+                             inputs=[ProcessingInput(
+                                 source=source,
+                                 destination='/opt/ml/processing/input',
+                                 s3_data_type=s3_data_type)],
+                             outputs=[ProcessingOutput(source='/opt/ml/processing/output',
+                                                       destination=output_url)]
+                             )
+    except Exception as e:
+        # run raises once the job fails; check the job's status below so the cache is updated in one place
+        if not script_processor.jobs:
+            # the job was never created, so nothing will read the manifest
+            if s3_data_type == 'ManifestFile':
+                delete_manifest(source)
+            raise
+        run_error = e
+    except BaseException:
+        # the job keeps running in SageMaker after Ctrl-C while waiting, and may not have read its input yet,
+        # so leave the manifest for it
+        if s3_data_type == 'ManifestFile':
+            warn('Leaving manifest %s in place for the processing job', source)
+        raise
+
+    # run waits for the job to finish so a single describe has the final status
+    description = script_processor.jobs[-1].describe()
+    status = description['ProcessingJobStatus']
+    if run_error is not None and status not in terminal_job_status:
+        # run stopped waiting, e.g. on a dropped connection, but the job is still going, so leave it and its manifest
+        if s3_data_type == 'ManifestFile':
+            warn('Leaving manifest %s in place for the processing job', source)
+        raise run_error
+
+    # the job is done with its input, so do not leave the manifest behind in the user's bucket
+    if s3_data_type == 'ManifestFile' and status in terminal_job_status:
+        delete_manifest(source)
 
     # log success/failure
-    if script_processor.jobs[-1].describe()['ProcessingJobStatus'] == 'Failed':
-        reason = script_processor.jobs[-1].describe()['FailureReason']
-        msg = f"Script processor failed for inputs s3://{input_s3.netloc}/{input_s3.path.lstrip('/')}: {reason}"
-        JobCache().set_job(base_job_name, processor, videos, JobStatus.FAILED)
-        for v in videos:
-            JobCache().set_media(base_job_name, v, JobStatus.FAILED)
-        err(msg)
-        raise Exception(msg)
+    if status == 'Completed':
+        debug("Script processor succeeded for inputs %s", input_url)
+        job_cache.defer('set_job_bulk', base_job_name, processor, videos, JobStatus.SUCCESS)
     else:
-        debug(f"Script processor succeeded for inputs s3://{input_s3.netloc}/{input_s3.path.lstrip('/')}")
-        JobCache().set_job(base_job_name, processor, videos, JobStatus.SUCCESS)
-        for v in videos:
-            JobCache().set_media(base_job_name, v, JobStatus.SUCCESS)
+        reason = description.get('FailureReason')
+        msg = f"Script processor {status.lower()} for inputs {input_url}: {reason}"
+        job_cache.defer('set_job_bulk', base_job_name, processor, videos, JobStatus.FAIL)
+        err(msg)
+        raise Exception(msg) from run_error
 
 
-def batch_run(resources: dict, video_path: Path, job_name: str, user_name: str, clean: bool, conf_thres: float, iou_thres: float):
+# processing job states after which the job no longer reads its input
+terminal_job_status = ('Completed', 'Failed', 'Stopped')
+
+# folder under the input prefix the manifests are written to, kept apart from the videos
+manifest_folder = '.manifests'
+
+
+def write_manifest(bucket: str, prefix: str, videos: List[str]) -> str:
+    """
+    Write a SageMaker manifest file listing the videos to process into a .manifests folder under the input prefix
+    :param bucket: The input bucket the videos are in
+    :param prefix: The folder the videos are in, ending in / or empty for the top of the bucket
+    :param videos: The video keys relative to the prefix
+    :return: The url of the manifest file
+    """
+    manifest_key = f'{prefix}{manifest_folder}/manifest-{uuid.uuid4()}.json'
+    manifest = [{'prefix': f's3://{bucket}/{prefix}'}] + videos
+    clients.s3_client().put_object(Bucket=bucket, Key=manifest_key, Body=_dumps(manifest).encode(),
+                                   ContentType='application/json')
+    manifest_url = f's3://{bucket}/{manifest_key}'
+    debug('Wrote manifest of %d videos to %s', len(videos), manifest_url)
+    return manifest_url
+
+
+def delete_manifest(manifest_url: str):
+    """
+    Delete a manifest file written by write_manifest
+    :param manifest_url: The url of the manifest file
+    """
+    manifest_s3 = s3url(manifest_url)
+    try:
+        clients.s3_client().delete_object(Bucket=manifest_s3.netloc, Key=manifest_s3.key)
+        debug('Deleted manifest %s', manifest_url)
+    except ClientError as e:
+        warn('Could not delete manifest %s: %s', manifest_url, e)
+
+
+# maximum number of messages SQS accepts in a single send_message_batch request
+max_batch_size = 10
+
+
+def _message_fields(job_name: str, user_name: str, clean: bool, conf_thres: float, iou_thres: float) -> str:
+    """
+    Serialize the fields shared by every processing message in a job
+    :return: The JSON object members without the enclosing braces
+    """
+    return _dumps({"clean": "True" if clean else "False",
+                   "user_name": user_name,
+                   "job_name": job_name,
+                   "conf_thres": conf_thres,
+                   "iou_thres": iou_thres})[1:-1]
+
+
+def _message_body(video_path: Path, fields: str) -> str:
+    """
+    Build the processing message for a video from the serialized shared fields
+    """
+    prefix_path = get_prefix(video_path)
+    return f'{{"video":{_dumps(f"{prefix_path}/{video_path.name}")},{fields}}}'
+
+
+def _group_id() -> str:
+    # create a message group based on the time; somewhat arbitrary; maybe refine to the hour to avoid collisions
+    # from multiple users submitting the same kind of job
+    return datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
+
+
+def batch_run(resources: dict, video_path: Path, job_name: str, user_name: str, clean: bool, conf_thres: float,
+              iou_thres: float):
     """
     Process a collection of videos in with a cluster in the Elastic Container Service [ECS]
     """
@@ -130,30 +260,55 @@ def batch_run(resources: dict, video_path: Path, job_name: str, user_name: str,
     queue_name = resources['VIDEO_QUEUE']
 
     # Get the service resource
-    sqs = boto3.resource('sqs')
-
-    prefix_path = get_prefix(video_path)
+    sqs = clients.sqs_resource()
 
     # Get the queue
     queue = sqs.get_queue_by_name(QueueName=queue_name)
-    message_dict = {"video": f"{prefix_path}/{video_path.name}",
-                    "clean": "True" if clean else "False",
-                    "user_name": user_name,
-                    "job_name": job_name,
-                    "conf_thres": conf_thres,
-                    "iou_thres": iou_thres}
-    json_object = json.dumps(message_dict, indent=4)
+    json_object = _message_body(video_path, _message_fields(job_name, user_name, clean, conf_thres, iou_thres))
 
-    now = datetime.utcnow()
-
-    # create a message group based on the time; somewhat arbitrary; maybe refine to the hour to avoid collisions
-    # from multiple users submitting the same kind of job
-    group_id = now.strftime("%Y%m%dT%H%M%SZ")
+    group_id = _group_id()
 
     # create a new message
     response = queue.send_message(MessageBody=json_object, MessageGroupId=resources['CLUSTER'] + f"{group_id}")
     info(f"Message queued to {queue_name}. MessageId: {response.get('MessageId')}")
 
     # log the video to the job cache
-    JobCache().set_job(job_name, resources['CLUSTER'], [video_path.name], JobStatus.QUEUED)
-    JobCache().set_media(job_name, video_path.name, JobStatus.QUEUED)
+    job_cache.defer('set_job_bulk', job_name, resources['CLUSTER'], [video_path.name], JobStatus.QUEUED)
+
+
+def batch_run_bulk(resources: dict, videos: List[Path], job_name: str, user_name: str, clean: bool,
+                   conf_thres: float, iou_thres: float) -> int:
+    """
+    Process a collection of videos with a cluster in the Elastic Container Service [ECS], queuing up to
+    max_batch_size messages per request
+    :return: The number of videos queued
+    """
+    # the queue to submit the processing message to
+    queue_name = resources['VIDEO_QUEUE']
+    queue = clients.sqs_resource().get_queue_by_name(QueueName=queue_name)
+    group_id = resources['CLUSTER'] + _group_id()
+    fields = _message_fields(job_name, user_name, clean, conf_thres, iou_thres)
+
+    queued = []
+    for i in range(0, len(videos), max_batch_size):
+        batch = videos[i:i + max_batch_size]
+        entries = [{'Id': str(j), 'MessageBody': _message_body(v, fields), 'MessageGroupId': group_id}
+                   for j, v in enumerate(batch)]
+        response = queue.send_message_batch(Entries=entries)
+
+        for m in response.get('Successful', []):
+            info(f"Message for {batch[int(m['Id'])].name} queued to {queue_name}. MessageId: {m['MessageId']}")
+            queued.append(batch[int(m['Id'])])
+
+        # retry any that failed individually
+        for m in response.get('Failed', []):
+            v = batch[int(m['Id'])]
+            warn(f"Failed to queue message for {v.name} to {queue_name}: {m.get('Message')}. Retrying...")
+            r = queue.send_message(MessageBody=entries[int(m['Id'])]['MessageBody'], MessageGroupId=group_id)
+            info(f"Message for {v.name} queued to {queue_name}. MessageId: {r.get('MessageId')}")
+            queued.append(v)
+
+    # log the videos to the job cache
+    names = [v.name for v in queued]
+    job_cache.defer('set_job_bulk', job_name, resources['CLUSTER'], names, JobStatus.QUEUED)
+    return len(queued)
@@ -14,17 +14,15 @@ Train a YOLOv5 model
 @license: __license__
 '''
 
-import boto3
 import random
 from tqdm import tqdm
 import os
-import sagemaker
 import shutil
 import tempfile
 import tarfile
 from pathlib import Path
 from urllib.parse import urlparse
-from sagemaker.estimator import Estimator
+from deepsea_ai.aws import clients
 from deepsea_ai.config import config as cfg
 from deepsea_ai.logger import info, err, warn, debug, exception, critical
 
@@ -47,7 +45,11 @@ def yolov5(data: [Path], input_s3: tuple, ckpts_s3: tuple, model_s3: tuple, epoc
     :param instance_type: Type of the AWS instance used, e.g. ml.p2.xlarge
     :param custom_config: configuration
     """
-    sagemaker_session = sagemaker.Session()
+    # sagemaker is slow to import so only load it when training
+    import sagemaker
+    from sagemaker.estimator import Estimator
+
+    sagemaker_session = sagemaker.Session(boto_session=clients.session())
 
     # if you are running this outside of a SageMaker notebook, you must set SAGEMAKER_ROLE
     role = custom_config.get_role()
@@ -123,7 +125,7 @@ def yolov5(data: [Path], input_s3: tuple, ckpts_s3: tuple, model_s3: tuple, epoc
     estimator.fit(inputs={'training': training_data})
 
     info(f'Checkpoints saved in {output_ckpts_s3}')
-    s3 = boto3.resource('s3')
+    s3 = clients.s3_resource()
     bb = s3.Bucket(model_s3.netloc)
     for obj in bb.objects.filter(Prefix=model_s3.path.lstrip('/')):
         if 'model.tar.gz' in obj.key:
@@ -139,8 +141,8 @@ def package(bucket_s3: tuple):
     :return:
     """
 
-    s3 = boto3.client('s3')
-    s3_resource = boto3.resource('s3')
+    s3 = clients.s3_client()
+    s3_resource = clients.s3_resource()
     b = s3_resource.Bucket(bucket_s3.netloc)
 
     with tempfile.TemporaryDirectory() as in_tmp_dir:
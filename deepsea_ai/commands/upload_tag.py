@@ -14,133 +14,84 @@ Bucket upload and tagging utility
 @license: __license__
 '''
 
+import functools
 from datetime import datetime
 
 import botocore
-import boto3
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from boto3.s3.transfer import TransferConfig
 from pathlib import Path
-from urllib.parse import urlparse
-from deepsea_ai.logger import info, err, debug, critical, exception, keys
+from urllib.parse import urlparse, urlencode
+from deepsea_ai.aws import clients
+from deepsea_ai.aws.s3url import S3Url
+from deepsea_ai.logger import info, err, debug, critical, exception
 
 from . import bucket
 
+# number of files to upload concurrently; each upload also uses the threads in its transfer config, and the client
+# connection pool is sized for both
+max_workers = clients.upload_workers
 
-def video_data(videos: [], input_s3: tuple, tags: dict):
+
+def video_data(videos: [], input_s3: S3Url, tags: dict, transfer_config: TransferConfig = None,
+               overwrite: bool = False):
     """
      Does an upload and tagging of a collection of videos to S3
     :param videos: Array of video files in the input_path to upload
-    :param input_s3: Base bucket to upload to, e.g. 902005-video-in-dev
+    :param input_s3: Bucket to upload to, e.g. s3url('s3://902005-video-in-dev'), with an optional key to upload
+    under
     :param tags: Tags to assign to the video
+    :param transfer_config: (optional) Multipart transfer settings for the upload; defaults to the shared settings
+    :param overwrite: (optional) Upload without checking if the video is already in S3
     :return: Uploaded bucket path, Size in GB of video data
     """
+    keys = [_video_key(v, input_s3) for v in videos]
+    _upload_and_tag(videos, keys, input_s3.netloc, tags, transfer_config, overwrite)
 
-    s3 = boto3.client('s3')
-    s3_resource = boto3.resource('s3')
+    output = video_folder(videos, input_s3)
+    size_gb = bucket.size(output)
+    return output, size_gb
 
-    # upload and tag the video objects individually
-    for v in videos:
-        prefix_path = get_prefix(v)
-        if input_s3.path:
-            target_prefix = f"{input_s3.path}/{prefix_path.lstrip('/')}/{v.name}"
-        else:
-            target_prefix = f"{prefix_path.lstrip('/')}/{v.name}"
 
-        # check if the video exists in s3
-        try:
-            s3_resource.Object(input_s3.netloc, target_prefix).load()
-        except botocore.exceptions.ClientError as e:
-            if e.response['Error']['Code'] == "404":
-                upload_success = False
-                # The video does not exist so upload and retry
-                for retry in range(10):
-                    try:
-                        with open(v.as_posix(), "rb") as f:
-                            info(f'Uploading {v} to s3://{input_s3.netloc}/{target_prefix}...')
-                            s3.upload_fileobj(f, input_s3.netloc, target_prefix)
-                            upload_success = True
-                            break
-                    except e:
-                        exception(e)
-                        exception(f"Error uploading {v} to s3. Retrying every 60 seconds...")
-                        time.sleep(60)
-
-                if not upload_success:
-                    critical(f"Error uploading {v} to s3 after {retry} retries. Aborting.")
-                    raise Exception(f"Error uploading {v} to s3 after {retry} retries. Aborting.")
-            else:
-                exception(e)
-                raise
-        else:
-            # the video does exist.
-            info(f'Found s3://{input_s3.netloc}/{target_prefix} ...skipping upload')
+def video_folder(videos: [], input_s3: S3Url) -> S3Url:
+    """
+    Get the folder video_data uploads a collection of videos to, without uploading them
+    :param videos: Array of video files in the input_path to upload
+    :param input_s3: Bucket to upload to, with an optional key to upload under, as passed to video_data
+    :return: The folder of the first video; like every S3Url key it has no trailing slash
+    """
+    return S3Url(input_s3.netloc, _video_key(videos[0], input_s3).rpartition('/')[0])
 
-        try:
-            # tag it
-            info(f'Tagging {v} with {tags}...')
-            s3.put_object_tagging(Bucket=input_s3.netloc, Key=f'{target_prefix}', Tagging={'TagSet': tags})
-        except Exception as error:
-            raise error
 
-        output = urlparse(f's3://{input_s3.netloc}/{prefix_path}/', allow_fragments=True)
-        size_gb = bucket.size(output)
-        return output, size_gb
+def _video_key(v: Path, input_s3: S3Url) -> str:
+    prefix_path = get_prefix(v)
+    if input_s3.key:
+        return f"{input_s3.key}/{prefix_path.lstrip('/')}/{v.name}"
+    return f"{prefix_path.lstrip('/')}/{v.name}"
 
 
-def training_data(data: [Path], input: tuple, tags: dict, training_prefix: str):
+def training_data(data: [Path], input: tuple, tags: dict, training_prefix: str, overwrite: bool = False):
     """
      Does an upload and tagging of training data to S3
     :param data: Paths to training data to upload
     :param input: Bucket to upload to
     :param bucket: Tags to assign to the video
     :param training_prefix: Training prefix to append to the bucket upload
+    :param overwrite: (optional) Upload without checking if the data is already in S3
     :return: Uploaded bucket path, Size in GB of training data
     """
-
-    # upload and tag the video objects individually
-    s3 = boto3.client('s3')
-    s3_resource = boto3.resource('s3')
-
-    prefix_path = None
-
     for d in data:
         if not d.exists():
             err(f"Error: {d} does not exist")
             exit(-1)
 
-    for d in data:
-        # arbitrarily pick the first element to form a prefix; it does not matter but can serve as an intuitive
-        # way to reference later.
-        if not prefix_path:
-            prefix_path = get_prefix(d)
-
-        # check if the data exists in s3
-        # all the data needs to be under the same prefix for training
-        target_prefix = f'{prefix_path}/{training_prefix}/{d.name}'
-        try:
-            s3_resource.Object(input.netloc, target_prefix).load()
-        except botocore.exceptions.ClientError as e:
-            info(f'{e} {d} does not exist in s3://{input.netloc}/{target_prefix}. Uploading...')
-            if e.response['Error']['Code'] == "404":
-                # The data does not exist so upload
-                try:
-                    with open(d.as_posix(), "rb") as f:
-                        info(f'Uploading {d} to s3://{input.netloc}/{target_prefix}...')
-                        s3.upload_fileobj(f, input.netloc, target_prefix)
-                except Exception as error:
-                    error(f"Error {error} uploading to s3")
-            else:
-                raise
-        else:
-            # the data already exist so skip over it
-            info(f'Found s3://{input.path}/{target_prefix} ...skipping upload')
-
-        try:
-            # tag it
-            s3.put_object_tagging(Bucket=input.netloc, Key=target_prefix, Tagging={'TagSet': tags})
-        except Exception as error:
-            exception(error)
-            raise error
+    # arbitrarily pick the first element to form a prefix; it does not matter but can serve as an intuitive
+    # way to reference later.
+    # all the data needs to be under the same prefix for training
+    prefix_path = get_prefix(data[0])
+    _upload_and_tag(data, [f'{prefix_path}/{training_prefix}/{d.name}' for d in data], input.netloc, tags,
+                    None, overwrite)
 
     output = urlparse(f"s3://{input.netloc}/{prefix_path.lstrip('/')}/{training_prefix}/")
     size_gb = bucket.size(output)
@@ -148,16 +99,163 @@ def training_data(data: [Path], input: tuple, tags: dict, training_prefix: str):
     return output, size_gb
 
 
+def _upload_and_tag(files: [Path], keys: [str], bucket_name: str, tags: dict, transfer_config: TransferConfig,
+                    overwrite: bool):
+    """
+     Upload and tag files to S3 concurrently, skipping the upload of any already there
+    :param files: Files to upload
+    :param keys: Key to upload each file to
+    :param bucket_name: Bucket to upload to
+    :param tags: Tags to assign to the files
+    :param transfer_config: Multipart transfer settings for the upload; None for the shared settings
+    :param overwrite: Upload without checking if the files are already in S3
+    """
+    # the client is shared across the threads and the tags are encoded once for all the uploads
+    s3 = clients.s3_client()
+    transfer_config = transfer_config or clients.transfer_config()
+    extra_args = _tagging(tags)
+    existing = None if overwrite else _existing(s3, bucket_name, keys)
+
+    def upload(file_key: tuple):
+        f, key = file_key
+        # check if the file exists in s3
+        if overwrite or not _in_s3(s3, bucket_name, key, existing):
+            _upload(s3, f, bucket_name, key, tags, extra_args, transfer_config)
+        else:
+            # the file does exist so only refresh its tags
+            info(f'Found s3://{bucket_name}/{key} ...skipping upload')
+            info(f'Tagging {f} with {tags}...')
+            s3.put_object_tagging(Bucket=bucket_name, Key=key, Tagging={'TagSet': tags})
+
+    _run(upload, list(zip(files, keys)))
+
+
+# error codes S3 returns for problems that clear up on their own, so an upload that fails with one is worth retrying
+transient_error_codes = {'RequestTimeout', 'RequestTimeTooSkewed', 'SlowDown', 'Throttling', 'ThrottlingException',
+                         'InternalError', 'ServiceUnavailable'}
+
+
+def _transient(e: BaseException) -> bool:
+    """
+    Check if an upload error is transient, e.g. a dropped connection or throttling, rather than permanent,
+    e.g. a missing file or denied access
+    :param e: The error raised by the upload
+    :return: True if the upload should be retried
+    """
+    # upload_file wraps the client error in an S3UploadFailedError, so look at what it was raised from
+    while e is not None:
+        if isinstance(e, (botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError)):
+            return True
+        if isinstance(e, botocore.exceptions.ClientError):
+            status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+            return e.response.get('Error', {}).get('Code') in transient_error_codes or status >= 500
+        e = e.__cause__ or e.__context__
+    return False
+
+
+def _upload(s3, f: Path, bucket_name: str, key: str, tags: dict, extra_args: dict, transfer_config: TransferConfig):
+    retries = 10
+    # The file does not exist so upload and retry on transient errors only; anything else fails right away
+    for retry in range(retries):
+        try:
+            info(f'Uploading {f} to s3://{bucket_name}/{key} with tags {tags}...')
+            s3.upload_file(Filename=f.as_posix(), Bucket=bucket_name, Key=key,
+                           ExtraArgs=extra_args, Config=transfer_config)
+            return
+        except Exception as e:
+            exception(e)
+            if not _transient(e):
+                critical(f"Error uploading {f} to s3. Aborting.")
+                raise
+            if retry < retries - 1:
+                exception(f"Error uploading {f} to s3. Retrying every 60 seconds...")
+                time.sleep(60)
+
+    critical(f"Error uploading {f} to s3 after {retries} retries. Aborting.")
+    raise Exception(f"Error uploading {f} to s3 after {retries} retries. Aborting.")
+
+
+def _tagging(tags: dict) -> dict:
+    """
+    Get the upload arguments that tag an object as it is uploaded, saving a separate tagging request
+    :param tags: Tags as a list of Key/Value pairs
+    :return: ExtraArgs for upload_file
+    """
+    return {'Tagging': urlencode({t['Key']: t['Value'] for t in tags})} if tags else {}
+
+
+def _existing(s3, bucket_name: str, keys: [str]) -> set:
+    """
+    List the objects already in S3 under the folders of the keys, so many files are checked with one request per
+    1000 objects instead of a HEAD request each
+    :param s3: S3 client
+    :param bucket_name: Bucket the objects are in
+    :param keys: Keys of the objects
+    :return: Set of the keys listed, or None for a single key, which is cheaper to check with a HEAD request
+    """
+    if len(keys) < 2:
+        return None
+    existing = set()
+    paginator = s3.get_paginator('list_objects_v2')
+    for folder in {k.rpartition('/')[0] + '/' for k in keys}:
+        # the delimiter keeps the listing to the folder itself and not everything below it
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=folder, Delimiter='/'):
+            existing.update(obj['Key'] for obj in page.get('Contents', []))
+    return existing
+
+
+def _in_s3(s3, bucket_name: str, key: str, existing: set) -> bool:
+    if existing is not None:
+        return key in existing
+    return _exists(s3, bucket_name, key)
+
+
+def _exists(s3, bucket_name: str, key: str) -> bool:
+    """
+    Check if an object exists in S3 with a single HEAD request
+    :param s3: S3 client
+    :param bucket_name: Bucket the object is in
+    :param key: Key of the object
+    :return: True if the object exists
+    """
+    try:
+        s3.head_object(Bucket=bucket_name, Key=key)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        exception(e)
+        raise
+    return True
+
+
+def _run(upload, files: []):
+    """
+    Run the upload of each file in a thread pool, raising the first error
+    :param upload: Function to upload a single file
+    :param files: Files to upload, or file and key pairs
+    """
+    if len(files) == 1:
+        upload(files[0])
+        return
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(files))) as executor:
+        for future in as_completed([executor.submit(upload, f) for f in files]):
+            future.result()
+
+
 def get_prefix(path: Path):
     """
     Get the prefix from a path, stripping away any volume or drive information
     :param path: Path to get the prefix from
     :return: Prefix
     """
-    prefix = None
+    # the videos in a collection mostly share a few parent directories, so the prefix is cached by the parent
+    return _parent_prefix(path.parent.as_posix())
+
+
+@functools.lru_cache(maxsize=1024)
+def _parent_prefix(parent: str):
     for m in ['Volumes/', 'mnt/', 'Users/', 'home/']:
-        if m in path.as_posix():
-            prefix = path.parent.as_posix().split(m)[-1].lstrip('/')
-            break
+        if m in f'{parent}/':
+            return parent.rpartition(m)[2].lstrip('/')
 
-    return prefix
+    return None
@@ -14,19 +14,51 @@ Configuration helper to setup defaults and fetch cloud configuration
 @license: __license__
 '''
 
+import functools
+import logging
+import re
 import string
+from concurrent.futures import ThreadPoolExecutor
+
+# google-re2 is optional; it matches the exclude patterns with a DFA, in time linear in the name length
+try:
+    import re2 as _re
+except ImportError:
+    _re = re
 
-import boto3
 from configparser import ConfigParser
 import datetime as dt
 import os
 from botocore.exceptions import ClientError
 from pathlib import Path
 from typing import List
-from deepsea_ai.logger import err, info, debug, warn, critical, exception
+from deepsea_ai.aws import clients
+from deepsea_ai.logger import err, info, debug, warn, critical, exception, custom_logger
 
 default_training_prefix = 'training'
 default_config_ini = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.ini')
+video_formats = ('.mov', '.avi', '.mp4', '.mpg', '.mpeg', '.m4v', '.wmv', '.mkv')  # acceptable video suffixes
+video_suffixes = frozenset(video_formats)
+# task environment variables returned by get_resources
+resource_env_keys = ('PROCESSOR', 'TRACK_QUEUE', 'VIDEO_QUEUE', 'DEAD_QUEUE', 'TRACK_BUCKET', 'VIDEO_BUCKET')
+scan_workers = 8  # number of threads to walk the top level directories of the videos with
+#  The allowed characters in tags across services are: letters (a-z, A-Z), numbers (0-9),
+#  and spaces representable in UTF-8, and the following characters: + - = . _ : / @.
+allowed_tag_chars = frozenset(string.ascii_letters + string.digits + '+-=._:/@')
+
+
+@functools.lru_cache(maxsize=8)
+def _parse(path: str, mtime: float) -> (str, ConfigParser):
+    """
+    Read and parse a config file; cached by the file modification time so the same file is only parsed once per run
+    :return: The text of the file and its parser
+    """
+    with open(path) as fp:
+        text = fp.read()
+    parser = ConfigParser()
+    parser.read_string(text, source=path)
+    return text, parser
+
 
 class Config:
 
@@ -34,7 +66,6 @@ class Config:
         """
         Read the .ini file and parse it
         """
-        self.parser = ConfigParser()
         if path:
             self.path = path
         else:
@@ -43,12 +74,10 @@ class Config:
         if not os.path.isfile(self.path):
             raise Exception(f'Bad path to {self.path}. Is your {self.path} missing?')
 
-        self.parser.read(self.path)
-        lines = open(self.path).readlines()
-        if not quiet:
-            info(f"=============== Config file {self.path} =================")
-            for l in lines:
-                info(l.strip())
+        text, self.parser = _parse(os.path.abspath(self.path), os.path.getmtime(self.path))
+        if not quiet and custom_logger().isEnabledFor(logging.INFO):
+            info("=============== Config file %s =================\n%s", self.path,
+                 '\n'.join(l.strip() for l in text.splitlines()))
 
             if not path:
                 info(f"============ You can override these settings by creating a customconfig.ini file and pass that "
@@ -77,37 +106,35 @@ class Config:
             raise Exception('Run deepsea-ai setup or set the SAGEMAKER_ROLE environment variable')
         return sagemaker_arn
 
-    staticmethod
-    def get_account(self) -> str:
+    @staticmethod
+    def get_account() -> str:
         """
         Get the account number associated with this user
         :return:
         """
-        account_number = boto3.client('sts').get_caller_identity()['Account']
+        account_number = clients.caller_identity()['Account']
         info(f'Found account {account_number}')
         return account_number
 
-    staticmethod
-    def get_region(self) -> str:
+    @staticmethod
+    def get_region() -> str:
         """
         Get the region associated with this user
         :return:
         """
-        session = boto3.session.Session()
-        region = session.region_name
+        region = clients.session().region_name
         info(f'Found region {region}')
         return region
 
-    staticmethod
-    def get_username(self) -> str:
+    @staticmethod
+    def get_username() -> str:
         """
         Get the user name using IAM; if IAM is not configured, this will default to the root user which may be the case
         for a new AWS account
         :return:
         """
         try:
-            sts = boto3.client('sts')
-            response = sts.get_caller_identity()
+            response = clients.caller_identity()
             user_name = response['Arn'].split("/")[-1].split("@")[0]
         except ClientError as e:
             # The user_name may be specified in the Access Denied message...
@@ -116,7 +143,6 @@ class Config:
         return user_name
 
 
-    staticmethod
     def get_tags(self, description: str) -> dict:
         """
         Configure tag dictionary to associate with any AWS resource.
@@ -142,48 +168,40 @@ class Config:
         # iterate over the tag dictionary and check the key and value
         for tag in tag_dict:
             info(f'Checking tag {tag}')
-            #  The allowed characters across services are: letters (a-z, A-Z), numbers (0-9),
-            #  and spaces representable in UTF-8, and the following characters: + - = . _ : / @.
-            allowed_chars = ['+', '-', '=', '.', '_', ':', '/', '@']
-            allowed_letters = list(string.ascii_letters)
-            allowed_numbers = list(string.digits)
-            allowed = allowed_chars + allowed_letters + allowed_numbers
-            if not any(char in tag['Value'] for char in allowed):
+            if allowed_tag_chars.isdisjoint(tag['Value']):
                 msg = f'Tag {tag} has a value with special characters. Check your config.ini file. ' \
                         f'Special characters are not allowed in AWS tags, e.g. dots, etc.'
                 err(msg)
-                raise (msg)
+                raise Exception(msg)
 
         return tag_dict
 
-    staticmethod
-    def get_resources(self, stack_name: str) -> dict:
+    @staticmethod
+    def get_resources(stack_name: str) -> dict:
         """
         Get resources relevant to the pipeline from the stack name; see deepsea-ai/cluster/stacks
         :param stack_name: name of the stack to query in the ECS cluster
         :return: dictionary with resource names
         """
-        client_cf = boto3.client('cloudformation')
-        client_ecs = boto3.client('ecs')
-
         try:
-            stack_resources = client_cf.list_stack_resources(StackName=stack_name)
             resources = {'CLUSTER': stack_name}
 
+            # find the single task and the auto scaling group in one pass over all the pages of stack resources
+            task_arn = None
+            paginator = clients.cloudformation_client().get_paginator('list_stack_resources')
+            for page in paginator.paginate(StackName=stack_name):
+                for r in page['StackResourceSummaries']:
+                    if task_arn is None and 'AWS::ECS::TaskDefinition' in r['ResourceType']:
+                        task_arn = r['PhysicalResourceId']
+                    elif 'AWS::AutoScaling::AutoScalingGroup' in r['ResourceType']:
+                        resources['ASG'] = r['PhysicalResourceId']
+
             # fetch the PROCESSOR, etc. environment variables for the single task in the stack; the job is keyed uniquely to it
-            key = ['PROCESSOR', 'TRACK_QUEUE', 'VIDEO_QUEUE', 'DEAD_QUEUE', 'TRACK_BUCKET', 'VIDEO_BUCKET']
-            for r in stack_resources['StackResourceSummaries']:
-                if 'AWS::ECS::TaskDefinition' in r['ResourceType']:
-                    arn = r['PhysicalResourceId']
-                    task_def = client_ecs.describe_task_definition(taskDefinition=arn)
-                    environment = task_def['taskDefinition']['containerDefinitions'][0]['environment']
-                    for e in environment:
-                        for k in key:
-                            if k in e['name']:
-                                resources[k] = e['value']
-                    break
-                if 'AWS::AutoScaling::AutoScalingGroup' in r['ResourceType']:
-                    resources['ASG'] = r['PhysicalResourceId']
+            if task_arn:
+                task_def = clients.ecs_client().describe_task_definition(taskDefinition=task_arn)
+                environment = task_def['taskDefinition']['containerDefinitions'][0]['environment']
+                env = {e['name']: e['value'] for e in environment}
+                resources.update({k: env[k] for k in resource_env_keys if k in env})
             return resources
         except ClientError as ex:
             exception(ex)
@@ -195,16 +213,14 @@ class Config:
                 raise Exception('Token expired')
         return None
 
-    staticmethod
-    def check_videos(self, input_path: Path, exclude: tuple) -> List[Path]:
+    @staticmethod
+    def check_videos(input_path: Path, exclude: tuple = ()) -> List[Path]:
         """
          Check for videos with acceptable suffixes and return the Paths to them
-        :param input_path: input path to search (non-recursively) or a single video file
+        :param input_path: input path to search (recursively) or a single video file
         :param exclude: directory or files to exclude from the list of videos to process
         :return:
         """
-        vid_formats = ['.mov', '.avi', '.mp4', '.mpg', '.mpeg', '.m4v', '.wmv', '.mkv']  # acceptable video suffixes
-
         # convert exclude tuple to list
         excludes = list(exclude)
         if len(excludes) > 0:
@@ -212,19 +228,12 @@ class Config:
         else:
             info(f'No video file exclusions specified')
 
-        def search(x: Path):
-            if excludes:
-                found = [x.name.__contains__(e) for e in excludes]
-                return (True not in found and x.suffix.lower() in vid_formats and '._' not in x.name)
-            else:
-                return (x.suffix.lower() in vid_formats and '._' not in x.name)
-
         # if the input path is a directory, search for videos
         videos = []
         if input_path.is_dir():
-            videos = [x for x in input_path.glob("**/*") if search(x)]
+            videos = _find_videos(input_path.as_posix(), tuple(excludes))
         else:
-            if search(input_path):
+            if _is_video(input_path.name, _exclude_pattern(tuple(excludes))):
                 videos = [input_path]
         num_videos = len(videos)
         info(f'Found {num_videos} videos to process')
@@ -233,3 +242,51 @@ class Config:
         assert (num_videos > 0), "No videos to process"
         video_paths = [Path(x) for x in videos]
         return video_paths
+
+
+@functools.lru_cache(maxsize=8)
+def _exclude_pattern(exclude: tuple):
+    """
+    Compile the exclude strings into a single pattern so each name is scanned once
+    """
+    return _re.compile('|'.join(_re.escape(e) for e in exclude)) if exclude else None
+
+
+def _is_video(name: str, pattern) -> bool:
+    return os.path.splitext(name)[1].lower() in video_suffixes and '._' not in name and \
+        not (pattern and pattern.search(name))
+
+
+def _find_videos(input_path: str, exclude: tuple) -> tuple:
+    """
+    Walk a directory once with os.scandir, skipping excluded directories, and return the videos found.
+    The top level directories are walked in threads, since listing a network mount is mostly waiting
+    """
+    pattern = _exclude_pattern(exclude)
+
+    def scan(path: str) -> (list, list):
+        videos, dirs = [], []
+        with os.scandir(path) as it:
+            for entry in it:
+                # do not follow directory links, like os.walk, so a link back up the tree cannot loop forever
+                if entry.is_dir(follow_symlinks=False):
+                    if not (pattern and pattern.search(entry.name)):
+                        dirs.append(entry.path)
+                elif _is_video(entry.name, pattern):
+                    videos.append(entry.path)
+        return videos, dirs
+
+    def walk(path: str) -> list:
+        videos, dirs = scan(path)
+        for d in dirs:
+            videos.extend(walk(d))
+        return videos
+
+    videos, dirs = scan(input_path)
+    if len(dirs) > 1:
+        with ThreadPoolExecutor(max_workers=min(scan_workers, len(dirs))) as executor:
+            for found in executor.map(walk, dirs):
+                videos.extend(found)
+    elif dirs:
+        videos.extend(walk(dirs[0]))
+    return tuple(videos)
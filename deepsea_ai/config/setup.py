@@ -7,8 +7,9 @@ import base64
 import json
 import subprocess
 
-import boto3
 from botocore.exceptions import ClientError
+
+from deepsea_ai.aws import clients
 from deepsea_ai.config import config as cfg
 from deepsea_ai.logger import err, info, debug, warn, exception
 
@@ -109,8 +110,7 @@ def create_role(account_id: str):
     Sets up the IAM role called DeepSeaAI to support ECR and SageMaker
     :param account_id: AWS account ID
     """
-    session = boto3.session.Session()
-    iam = session.client('iam')
+    iam = clients.iam_client()
 
     path = '/'
     role_name = 'DeepSeaAI'
@@ -163,7 +163,7 @@ def create_role(account_id: str):
 
         policy = f"{role_name}GetAndPassRolePolicy"
 
-        iam = session.client('iam')
+        iam = clients.iam_client()
 
         iam.create_policy(
             PolicyName=policy,
@@ -203,8 +203,7 @@ def store_role(config: cfg):
     """
     Save the role in the config
     """
-    session = boto3.session.Session()
-    iam = session.client('iam')
+    iam = clients.iam_client()
     results = iam.get_role(RoleName="DeepSeaAI")
     role_arn = results['Role']['Arn']
     info(f'Setting SageMaker Role ARN to {role_arn} in {config.path}')
@@ -218,7 +217,7 @@ if __name__ == "__main__":
     region = default_config.get_region()
     image_cfg = ['yolov5_ecr', 'deepsort_ecr', 'strongsort_ecr']
     image_tags = [default_config('aws', t) for t in image_cfg]
-    mirror_docker_hub_images_to_ecr(ecr_client=boto3.client("ecr"), account_id=account, region=region, image_tags=image_tags)
+    mirror_docker_hub_images_to_ecr(ecr_client=clients.ecr_client(), account_id=account, region=region, image_tags=image_tags)
     create_role(account_id=account)
     store_role(default_config)
 
@@ -19,6 +19,16 @@ query getMediaInJob($processing_job_name: String!, $media_name: String!) {
 }
 """
 
+GET_ALL_MEDIA_IN_JOB = """
+query getAllMediaInJob($processing_job_name: String!) {
+    allMediaInJob(processing_job_name: $processing_job_name)
+    {
+        name
+        uuid
+    }
+}
+"""
+
 GET_JOB_SUMMARY = """
 query getJobSummary($job_uuid: String!) {
   jobs(where: {
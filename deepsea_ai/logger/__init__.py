@@ -16,33 +16,51 @@ Creates a global data frame to store a summary of the results.
 @license: __license__
 '''
 
+import functools
 import logging
+import logging.handlers
+import threading
 from pathlib import Path
 from datetime import datetime as dt
 
-import pandas as pd
-
 LOGGER_NAME = "DSEAAI"
 DEBUG = True
 keys = ["job", "video", "time", "status", "message"]
 
+# the logger is looked up once; getLogger takes a lock on every call
+_LOGGER = logging.getLogger(LOGGER_NAME)
+
 
-class _Singleton(type):
-    """ A metaclass that creates a Singleton base class when called. """
-    _instances = {}
+class _TimedMemoryHandler(logging.handlers.MemoryHandler):
+    """
+    Buffer log records and write them to the target when the buffer is full, on an error, or flush_interval seconds
+    after the first record is buffered. The timed flush runs in a timer thread, so the file keeps up even while a
+    command is blocked waiting on a long job
+    """
 
-    def __call__(cls, *args, **kwargs):
-        if cls not in cls._instances:
-            cls._instances[cls] = super(_Singleton, cls).__call__(*args, **kwargs)
-        return cls._instances[cls]
+    def __init__(self, capacity: int, flush_interval: float, flushLevel: int, target: logging.Handler):
+        super().__init__(capacity, flushLevel=flushLevel, target=target)
+        self.flush_interval = flush_interval
+        self._timer = None
 
+    def emit(self, record: logging.LogRecord):
+        # handle() holds the lock while emitting
+        super().emit(record)
+        if self.buffer and self._timer is None:
+            self._timer = threading.Timer(self.flush_interval, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
 
-class Singleton(_Singleton('SingletonMeta', (object,), {})): pass
+    def flush(self):
+        with self.lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            super().flush()
 
 
-class CustomLogger(Singleton):
+class CustomLogger:
     logger = None
-    summary_df = None
     output_path = Path.cwd()
 
     def __init__(self, output_path: Path = Path.cwd(), output_prefix: str = "deepsea_ai"):
@@ -50,22 +68,28 @@ class CustomLogger(Singleton):
         Initialize the logger
         """
         global keys
-        # create a global data frame to store a summary of the results and constrain the header to
-        # the dictionary keys
+        # keep a summary of the results as rows with the dictionary keys; the data frame is only built when read
         self.keys = keys
-        self.summary_df = pd.DataFrame(columns=self.keys)
-        self.logger = logging.getLogger(LOGGER_NAME)
+        self._rows = []
+        self.logger = _LOGGER
         self.logger.setLevel(logging.DEBUG)
+
+        # replace the handlers of any earlier logger so records are not written twice
+        for h in list(self.logger.handlers):
+            self.logger.removeHandler(h)
+            h.close()
         self.output_path = output_path
         formatter = logging.Formatter("%(asctime)s %(levelname)s %(message)s")
 
         # default log file date to today
         now = dt.utcnow()
 
-        # log to file
+        # log to file; append to any earlier log from today, only open the file on the first record and buffer a few
+        # writes, flushing on errors, within a few seconds of each write and at exit
         self.log_filename = output_path / f"{output_prefix}_{now:%Y%m%d}.log"
-        handler = logging.FileHandler(self.log_filename, mode="w")
-        handler.setFormatter(formatter)
+        file_handler = logging.FileHandler(self.log_filename, mode="a", delay=True)
+        file_handler.setFormatter(formatter)
+        handler = _TimedMemoryHandler(capacity=32, flush_interval=2, flushLevel=logging.ERROR, target=file_handler)
         handler.setLevel(logging.INFO)
         self.logger.addHandler(handler)
 
@@ -77,6 +101,21 @@ class CustomLogger(Singleton):
 
         self.logger.info(f"Logging to {self.log_filename}")
 
+    def add_row(self, **row):
+        """
+        Add a row to the summary of the results, e.g. add_row(job=job, video=video, status=status)
+        """
+        self._rows.append(row)
+
+    @property
+    def summary_df(self):
+        """
+        Summary of the results as a data frame with a column for each of the keys
+        """
+        # pandas is slow to import so only load it when the summary is read
+        import pandas as pd
+        return pd.DataFrame.from_records(self._rows, columns=self.keys)
+
     def loggers(self) -> logging.Logger:
         return self.logger
 
@@ -87,6 +126,11 @@ def create_logger_file(log_path: Path, prefix: str = "deepsea_ai"):
     """
     # create the log directory if it doesn't exist
     log_path.mkdir(parents=True, exist_ok=True)
+    return _get_logger(log_path, prefix)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_logger(log_path: Path, prefix: str) -> CustomLogger:
     return CustomLogger(log_path, prefix)
 
 
@@ -94,28 +138,30 @@ def custom_logger() -> logging.Logger:
     """
     Get the logger
     """
-    return logging.getLogger(LOGGER_NAME)
+    return _LOGGER
 
 
-def err(s: str):
-    custom_logger().error(s)
+# the helpers take optional %-style arguments so formatting is deferred until a record is emitted, e.g.
+# info('Uploading %s', video)
+def err(s: str, *args):
+    _LOGGER.error(s, *args)
 
 
-def info(s: str):
-    custom_logger().info(s)
+def info(s: str, *args):
+    _LOGGER.info(s, *args)
 
 
-def debug(s: str):
-    custom_logger().debug(s)
+def debug(s: str, *args):
+    _LOGGER.debug(s, *args)
 
 
-def warn(s: str):
-    custom_logger().warning(s)
+def warn(s: str, *args):
+    _LOGGER.warning(s, *args)
 
 
-def exception(s: str):
-    custom_logger().exception(s)
+def exception(s: str, *args):
+    _LOGGER.exception(s, *args)
 
 
-def critical(s: str):
-    custom_logger().critical(s)
+def critical(s: str, *args):
+    _LOGGER.critical(s, *args)
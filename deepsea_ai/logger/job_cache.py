@@ -16,13 +16,17 @@ Can be used to generate a summary of jobs that have been run.
 @license: __license__
 '''
 
-import boto3
+import atexit
+import queue
 import pickledb
+import threading
 from pathlib import Path
 from typing import List
 import deepsea_ai.logger as logger
-from deepsea_ai.logger import info, err, debug, warn
+from deepsea_ai.aws import clients
+from deepsea_ai.logger import info, err, debug, warn, exception
 import hashlib
+from contextlib import contextmanager
 from datetime import datetime as dt, datetime
 from deepsea_ai import __version__
 
@@ -56,14 +60,38 @@ def job_hash(job: str) -> str:
     return f"{md5val[:8]}-{md5val[8:12]}-{md5val[12:16]}-{md5val[16:20]}-{md5val[20:]}".upper()
 
 
-class JobCache(logger.Singleton):
+class JobCache:
+    """
+    Singleton cache; the first call sets the output path and later calls, e.g. JobCache(), return the same cache
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __new__(cls, *args, **kwargs):
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = super().__new__(cls)
+                cls._instance.db = None
+        return cls._instance
 
-    def __init__(self, output_path: Path):
+    def __init__(self, output_path: Path = None):
         """
         Initialize the cache with the account number we are running in
         """
+        with JobCache._instance_lock:
+            if self.db is not None:
+                return
+            if output_path is None:
+                raise Exception('JobCache must be initialized with an output path')
+
+            # the database is dumped to disk on every write, so serialize writers from multiple threads;
+            # reentrant so the background writer can batch several writes under one dump
+            self.lock = threading.RLock()
+            self._open(output_path)
+
+    def _open(self, output_path: Path):
         # get the AWS account number
-        account_number = boto3.client('sts').get_caller_identity().get('Account')
+        account_number = clients.caller_identity().get('Account')
 
         # create the output path if it doesn't exist
         output_path.mkdir(parents=True, exist_ok=True)
@@ -153,7 +181,42 @@ class JobCache(logger.Singleton):
         else:
             info(f"Updating video file {media_file} to job {job_name} in cache with status {status}")
 
-        self.db.set(media_uuid, [media_file, job_uuid, update_dt, status])
+        with self.lock:
+            self.db.set(media_uuid, [media_file, job_uuid, update_dt, status])
+
+    def set_media_bulk(self, job_name: str, media_files: List[str], status: str = JobStatus.RUNNING):
+        """
+        Add a collection of video files to the cache with the same status, writing the cache to disk once
+        :param job_name: The name of the job
+        :param media_files: The video files
+        :param status: The status of the job
+        """
+        job_uuid = job_hash(job_name)
+        update_dt = dt.utcnow().strftime("%Y%m%dT%H%M%S")
+        if status == JobStatus.FAIL or status == JobStatus.UNKNOWN:
+            err(f"Updating {len(media_files)} video files in job {job_name} in cache with status {status}")
+        else:
+            info(f"Updating {len(media_files)} video files in job {job_name} in cache with status {status}")
+
+        with self._deferred_dump():
+            for media_file in media_files:
+                self.db.set(job_hash(media_file + job_name), [media_file, job_uuid, update_dt, status])
+
+    @contextmanager
+    def _deferred_dump(self):
+        """
+        Hold the cache lock and suspend the dump on every set, dumping once on exit. Nested calls dump only
+        when the outermost exits
+        """
+        with self.lock:
+            auto_dump = self.db.auto_dump
+            self.db.auto_dump = False
+            try:
+                yield
+            finally:
+                self.db.auto_dump = auto_dump
+            if auto_dump:
+                self.db.dump()
 
     def set_job(self, job_name: str, cluster: str, video_files: List[str], status: JobStatus):
         """
@@ -163,6 +226,26 @@ class JobCache(logger.Singleton):
         :param video_files: The video files associated with the job
         :param status: The status of the job
         """
+        with self.lock:
+            self._set_job(job_name, cluster, video_files, status)
+
+        info(f"Added job {job_name} running on {cluster} to cache")
+
+    def set_job_bulk(self, job_name: str, cluster: str, video_files: List[str], status: JobStatus):
+        """
+        Add a job and all of its video files to the cache with the same status, writing the cache to disk once
+        :param job_name: The name of the job
+        :param cluster: The cluster the job is running on
+        :param video_files: The video files associated with the job
+        :param status: The status of the job and the video files
+        """
+        with self._deferred_dump():
+            self.set_media_bulk(job_name, video_files, status)
+            self._set_job(job_name, cluster, list(video_files), status)
+
+        info(f"Added job {job_name} running on {cluster} to cache")
+
+    def _set_job(self, job_name: str, cluster: str, video_files: List[str], status: JobStatus):
         job_uuid = job_hash(job_name)
         j = self.db.get(job_uuid)
         if j:
@@ -189,8 +272,6 @@ class JobCache(logger.Singleton):
                                updated_timestamp,
                                status])
 
-        info(f"Added job {job_name} running on {cluster} to cache")
-
     def get_job(self, job_name: str) -> List[str]:
         """
         Get a job from the cache. A job is uniquely identified by the hash of the job name
@@ -328,3 +409,58 @@ if __name__ == '__main__':
 
     # clean-up
     jc.remove_job(name)
+
+
+# writes queued with defer() are done by a single background thread, so callers do not wait on the disk
+_queue = queue.Queue()
+_writer_thread = None
+_writer_lock = threading.Lock()
+batch_window = 0.05  # seconds to wait for more writes to batch under one dump
+
+
+def _writer():
+    while True:
+        batch = [_queue.get()]
+        try:
+            while True:
+                batch.append(_queue.get(timeout=batch_window))
+        except queue.Empty:
+            pass
+
+        # mark the writes done only after the dump so flush() returns once they are on disk
+        try:
+            cache = JobCache()
+            with cache._deferred_dump():
+                for op, args in batch:
+                    try:
+                        getattr(cache, op)(*args)
+                    except Exception as e:
+                        exception(e)
+        except Exception as e:
+            exception(e)
+        finally:
+            for _ in batch:
+                _queue.task_done()
+
+
+def defer(op: str, *args):
+    """
+    Queue a write to the job cache, e.g. defer('set_job_bulk', job_name, cluster, videos, JobStatus.RUNNING).
+    The writes are done in order by a background thread; call flush() to wait for them
+    :param op: The name of the JobCache method to call
+    :param args: The arguments to the method
+    """
+    global _writer_thread
+    with _writer_lock:
+        if _writer_thread is None:
+            _writer_thread = threading.Thread(target=_writer, name='job-cache-writer', daemon=True)
+            _writer_thread.start()
+            atexit.register(flush)
+    _queue.put((op, args))
+
+
+def flush():
+    """
+    Wait for all the queued writes to the job cache to finish
+    """
+    _queue.join()
@@ -0,0 +1,91 @@
+# !/usr/bin/env python
+__author__ = "Danelle Cline"
+__copyright__ = "Copyright 2023, MBARI"
+__credits__ = ["MBARI"]
+__license__ = "GPL"
+__maintainer__ = "Danelle Cline"
+__email__ = "dcline at mbari.org"
+__doc__ = '''
+
+Simple on-disk cache of the media already loaded into the deepsea-ai database per processing job.
+Avoids repeating the same GraphQL query on back-to-back runs of the same job.
+
+@author: __author__
+@status: __status__
+@license: __license__
+'''
+
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+from typing import List, Set
+
+from deepsea_ai.logger import debug, warn
+
+cache_path = Path('logs') / '.gql_cache'
+default_ttl = 300  # seconds
+
+
+def _cache_file(job: str) -> Path:
+    return cache_path / f"{hashlib.sha1(job.encode('utf-8')).hexdigest()}.json"
+
+
+def _write(job: str, ts: float, media: List[str]):
+    cache_path.mkdir(parents=True, exist_ok=True)
+    cache_file = _cache_file(job)
+    tmp_file = cache_file.with_suffix('.tmp')
+    try:
+        with open(tmp_file, 'w') as fp:
+            json.dump({'ts': ts, 'media': media}, fp)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        warn(f'Unable to write query cache for {job}: {e}')
+
+
+def get(job: str, ttl: int = default_ttl) -> Set[str]:
+    """
+    Get the cached media names for a processing job
+    :param job: The name of the processing job
+    :param ttl: Maximum age in seconds of the cached entry
+    :return: Set of media names, or None if there is no entry or it has expired
+    """
+    try:
+        with open(_cache_file(job)) as fp:
+            entry = json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+    age = time.time() - entry['ts']
+    if age > ttl:
+        debug(f'Query cache for {job} expired {age - ttl:.0f} seconds ago')
+        return None
+
+    debug(f'Using query cache for {job} from {age:.0f} seconds ago')
+    return set(entry['media'])
+
+
+def put(job: str, media: Set[str]):
+    """
+    Cache the media names for a processing job
+    :param job: The name of the processing job
+    :param media: The media names already loaded for the job
+    """
+    _write(job, time.time(), sorted(media))
+
+
+def append(job: str, media: List[str]):
+    """
+    Add newly submitted media to the cached entry for a processing job so the next run skips them.
+    The entry keeps its original timestamp, so it still expires with the ttl.
+    :param job: The name of the processing job
+    :param media: The media names to add
+    """
+    try:
+        with open(_cache_file(job)) as fp:
+            entry = json.load(fp)
+    except (OSError, ValueError):
+        return
+
+    _write(job, entry['ts'], sorted(set(entry['media']).union(media)))
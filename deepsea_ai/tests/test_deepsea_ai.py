@@ -4,4 +4,290 @@ def test_config():
     os.environ['SAGEMAKER_ROLE']="arn:aws:iam::123456789012:role/service-role/AmazonSageMaker-ExecutionRole-20201231T123456"
     from deepsea_ai.config.config import Config
     c = Config()
-    assert c.get_role() is not None
\ No newline at end of file
+    assert c.get_role() is not None
+
+def test_query_cache(tmp_path, monkeypatch):
+    from deepsea_ai.logger import query_cache
+    monkeypatch.setattr(query_cache, 'cache_path', tmp_path)
+    job = "strongsort-yolov5-benthic33k-Dive1334"
+    assert query_cache.get(job) is None
+    query_cache.put(job, {"video1.mp4"})
+    query_cache.append(job, ["video2.mp4"])
+    assert query_cache.get(job) == {"video1.mp4", "video2.mp4"}
+    # expired entries are ignored
+    assert query_cache.get(job, ttl=-1) is None
+
+
+def test_s3url():
+    from deepsea_ai.aws.s3url import s3url
+    u = s3url("s3://902005-video-in-dev/Dive1423/")
+    assert u.netloc == "902005-video-in-dev"
+    assert u.key == "Dive1423"
+    assert u.path == "/Dive1423"
+    assert u.url() == "s3://902005-video-in-dev/Dive1423"
+    assert s3url("s3://902005-video-in-dev").url() == "s3://902005-video-in-dev/"
+
+
+def test_check_videos(tmp_path):
+    from deepsea_ai.config.config import Config
+    (tmp_path / "D1371").mkdir()
+    (tmp_path / "D1371" / "D1371_20210801T000000Z.mp4").touch()
+    (tmp_path / "D1372").mkdir()
+    (tmp_path / "D1372" / "D1372_20210802T000000Z.MOV").touch()
+    (tmp_path / "D1372" / "._D1372_20210802T000000Z.mov").touch()
+    (tmp_path / "D1372" / "D1372.json").touch()
+    # a link back up the tree is not followed
+    (tmp_path / "D1372" / "loop").symlink_to(tmp_path, target_is_directory=True)
+    c = Config(quiet=True)
+    assert len(c.check_videos(tmp_path, ())) == 2
+    assert c.check_videos(tmp_path, ("D1371",)) == [tmp_path / "D1372" / "D1372_20210802T000000Z.MOV"]
+    # a video added to a subdirectory is found, even though the top directory is unchanged
+    (tmp_path / "D1371" / "D1371_20210801T010000Z.mp4").touch()
+    assert len(c.check_videos(tmp_path, ())) == 3
+
+
+def test_config_parse_cache(tmp_path):
+    from deepsea_ai.config.config import Config
+    ini = tmp_path / "custom.ini"
+    ini.write_text("[aws]\nyolov5_ecr = yolov5:1.0\n")
+    # the same unchanged file is only parsed once
+    assert Config(ini.as_posix(), quiet=True).parser is Config(ini.as_posix(), quiet=True).parser
+    # a changed file is parsed again
+    ini.write_text("[aws]\nyolov5_ecr = yolov5:1.1\n")
+    os.utime(ini, (0, 0))
+    assert Config(ini.as_posix(), quiet=True)('aws', 'yolov5_ecr') == 'yolov5:1.1'
+
+
+def test_get_prefix():
+    from pathlib import Path
+    from deepsea_ai.commands.upload_tag import get_prefix
+    assert get_prefix(Path("/Volumes/M3/mezzanine/Ventana/2022/09/4432/V4432_20220914T170422Z.mov")) == \
+        "M3/mezzanine/Ventana/2022/09/4432"
+    assert get_prefix(Path("/mnt/data/Volumes/M3/V4432.mov")) == "M3"
+    assert get_prefix(Path("/tmp/V4432.mov")) is None
+
+
+class _StubPaginator:
+    def __init__(self, pages):
+        self.pages = pages
+        self.calls = []
+
+    def paginate(self, **kwargs):
+        self.calls.append(kwargs)
+        return self.pages
+
+
+def _stub_script_processor(monkeypatch, s3, status="Completed"):
+    """
+    Stand in for the SageMaker processor and the job cache around script_processor_run, listing one video
+    """
+    import sys
+    import types
+    from unittest import mock
+    from deepsea_ai.commands import upload_tag
+    from deepsea_ai.logger import job_cache
+
+    monkeypatch.setattr(upload_tag.clients, "s3_client", lambda: s3)
+    paginator = _StubPaginator([{"Contents": [{"Key": "M3/D/V4432_20220914T170422Z.mov"},
+                                              {"Key": "M3/D/V4432_20220914T170422Z.json"}]}])
+    s3.get_paginator.return_value = paginator
+    cached = []
+    monkeypatch.setattr(job_cache, "defer", lambda op, *args: cached.append((op, args)))
+    processor = mock.Mock()
+    processor.jobs = [mock.Mock()]
+    processor.jobs[-1].describe.return_value = {"ProcessingJobStatus": status}
+    # stand in for sagemaker so the test does not depend on the installed version
+    sagemaker_processing = types.ModuleType("sagemaker.processing")
+    sagemaker_processing.ScriptProcessor = lambda **kwargs: processor
+    sagemaker_processing.ProcessingInput = types.SimpleNamespace
+    sagemaker_processing.ProcessingOutput = types.SimpleNamespace
+    monkeypatch.setitem(sys.modules, "sagemaker.processing", sagemaker_processing)
+    return paginator, processor, cached
+
+
+def _script_processor_run(input_s3):
+    from unittest import mock
+    from deepsea_ai.aws.s3url import s3url
+    from deepsea_ai.commands import process
+
+    config = mock.Mock(return_value="s3://902005-config/track.yaml")
+    config.get_account.return_value = "123456789012"
+    process.script_processor_run(input_s3, s3url("s3://902005-tracks-out-dev/20230101T000000Z"),
+                                 s3url("s3://902005-models/yolov5x.tar.gz"), 640, None, 10, "ml.g4dn.xlarge",
+                                 None, False, 0.01, 0.1, "strongsort", config, [])
+
+
+def test_script_processor_run_listing(tmp_path, monkeypatch):
+    from unittest import mock
+    from deepsea_ai.aws.s3url import s3url
+    from deepsea_ai.commands import bucket, upload_tag
+
+    video = tmp_path / "Volumes" / "M3" / "D" / "V4432_20220914T170422Z.mov"
+    video.parent.mkdir(parents=True)
+    video.touch()
+
+    s3 = mock.Mock()
+    s3.head_object.return_value = {}
+    paginator, processor, cached = _stub_script_processor(monkeypatch, s3)
+    monkeypatch.setattr(bucket, "size", lambda b: 1)
+    input_s3, _ = upload_tag.video_data([video], s3url("s3://902005-video-in-dev"), [])
+    assert input_s3.key == "M3/D"
+
+    _script_processor_run(input_s3)
+
+    assert paginator.calls[0]["Prefix"] == "M3/D/"
+    assert cached[0][1][2] == ["V4432_20220914T170422Z.mov"]
+    processing_input = processor.run.call_args.kwargs["inputs"][0]
+    assert processing_input.s3_data_type == "ManifestFile"
+    assert processing_input.source.startswith("s3://902005-video-in-dev/M3/D/.manifests/manifest-")
+    # the manifest is removed once the job is done
+    s3.delete_object.assert_called_once_with(Bucket="902005-video-in-dev", Key=s3url(processing_input.source).key)
+
+
+def test_script_processor_run_interrupted(monkeypatch):
+    from unittest import mock
+    import pytest
+    from deepsea_ai.aws.s3url import S3Url
+
+    s3 = mock.Mock()
+    _, processor, _ = _stub_script_processor(monkeypatch, s3, status="InProgress")
+    processor.run.side_effect = KeyboardInterrupt
+    with pytest.raises(KeyboardInterrupt):
+        _script_processor_run(S3Url("902005-video-in-dev", "M3/D"))
+    # the job keeps running in SageMaker, so its manifest is left for it
+    s3.delete_object.assert_not_called()
+
+
+def test_upload_retries_transient_only(monkeypatch):
+    from pathlib import Path
+    from unittest import mock
+    import botocore.exceptions
+    import pytest
+    from deepsea_ai.commands import upload_tag
+
+    sleeps = []
+    monkeypatch.setattr(upload_tag.time, "sleep", sleeps.append)
+    s3 = mock.Mock()
+    # a missing file is permanent so it fails without waiting to retry
+    s3.upload_file.side_effect = FileNotFoundError("V4432_20220914T170422Z.mov")
+    with pytest.raises(FileNotFoundError):
+        upload_tag._upload(s3, Path("V4432_20220914T170422Z.mov"), "902005-video-in-dev", "M3/D/V4432.mov", [], {}, None)
+    assert s3.upload_file.call_count == 1 and not sleeps
+
+    # throttling clears up so the upload is tried again
+    slow_down = botocore.exceptions.ClientError({"Error": {"Code": "SlowDown"},
+                                                 "ResponseMetadata": {"HTTPStatusCode": 503}}, "PutObject")
+    s3.upload_file.reset_mock()
+    s3.upload_file.side_effect = [slow_down, None]
+    upload_tag._upload(s3, Path("V4432_20220914T170422Z.mov"), "902005-video-in-dev", "M3/D/V4432.mov", [], {}, None)
+    assert s3.upload_file.call_count == 2 and sleeps == [60]
+
+
+def test_upload_and_tag_existing(monkeypatch):
+    from pathlib import Path
+    from unittest import mock
+    import botocore.exceptions
+    from deepsea_ai.commands import upload_tag
+
+    tags = [{"Key": "project", "Value": "deepsea-ai"}]
+    s3 = mock.Mock()
+    monkeypatch.setattr(upload_tag.clients, "s3_client", lambda: s3)
+
+    # a single file is checked with a HEAD request instead of listing its folder
+    s3.head_object.side_effect = botocore.exceptions.ClientError({"Error": {"Code": "404"}}, "HeadObject")
+    upload_tag._upload_and_tag([Path("V1.mov")], ["M3/D/V1.mov"], "902005-video-in-dev", tags, mock.Mock(), False)
+    s3.head_object.assert_called_once_with(Bucket="902005-video-in-dev", Key="M3/D/V1.mov")
+    s3.get_paginator.assert_not_called()
+    assert s3.upload_file.call_count == 1
+
+    # many files are checked by listing their folder once; only the ones already there have their tags refreshed
+    s3.reset_mock()
+    paginator = _StubPaginator([{"Contents": [{"Key": "M3/D/V1.mov"}]}])
+    s3.get_paginator.return_value = paginator
+    upload_tag._upload_and_tag([Path("V1.mov"), Path("V2.mov")], ["M3/D/V1.mov", "M3/D/V2.mov"],
+                               "902005-video-in-dev", tags, mock.Mock(), False)
+    s3.head_object.assert_not_called()
+    assert paginator.calls == [{"Bucket": "902005-video-in-dev", "Prefix": "M3/D/", "Delimiter": "/"}]
+    s3.put_object_tagging.assert_called_once_with(Bucket="902005-video-in-dev", Key="M3/D/V1.mov",
+                                                  Tagging={"TagSet": tags})
+    assert [c.kwargs["Key"] for c in s3.upload_file.call_args_list] == ["M3/D/V2.mov"]
+
+
+def test_batch_run_bulk_resends_failed(monkeypatch):
+    from pathlib import Path
+    from unittest import mock
+    from deepsea_ai.commands import process
+    from deepsea_ai.logger import job_cache
+
+    queue = mock.Mock()
+    queue.send_message_batch.return_value = {"Successful": [{"Id": "0", "MessageId": "m0"}],
+                                             "Failed": [{"Id": "1", "Message": "throttled"}]}
+    queue.send_message.return_value = {"MessageId": "m1"}
+    sqs = mock.Mock()
+    sqs.get_queue_by_name.return_value = queue
+    monkeypatch.setattr(process.clients, "sqs_resource", lambda: sqs)
+    cached = []
+    monkeypatch.setattr(job_cache, "defer", lambda op, *args: cached.append((op, args)))
+    videos = [Path("/Volumes/M3/D/V1.mov"), Path("/Volumes/M3/D/V2.mov")]
+    resources = {"VIDEO_QUEUE": "video-queue.fifo", "CLUSTER": "benthic33k"}
+
+    assert process.batch_run_bulk(resources, videos, "Dive1334", "902005", False, 0.01, 0.1) == 2
+    # the failed entry is sent again on its own with the same body
+    failed_body = queue.send_message_batch.call_args.kwargs["Entries"][1]["MessageBody"]
+    assert queue.send_message.call_args.kwargs["MessageBody"] == failed_body
+    assert cached[0][1][2] == ["V1.mov", "V2.mov"]
+
+
+def test_get_resources_paginated(monkeypatch):
+    from unittest import mock
+    from deepsea_ai.config import config as cfg
+
+    # the auto scaling group is on a later page than the task definition
+    paginator = _StubPaginator([
+        {"StackResourceSummaries": [{"ResourceType": "AWS::ECS::TaskDefinition", "PhysicalResourceId": "task-arn"}]},
+        {"StackResourceSummaries": [{"ResourceType": "AWS::AutoScaling::AutoScalingGroup",
+                                     "PhysicalResourceId": "benthic33k-asg"}]}])
+    cloudformation = mock.Mock()
+    cloudformation.get_paginator.return_value = paginator
+    ecs = mock.Mock()
+    ecs.describe_task_definition.return_value = {"taskDefinition": {"containerDefinitions": [
+        {"environment": [{"name": "VIDEO_QUEUE", "value": "video-queue.fifo"}]}]}}
+    monkeypatch.setattr(cfg.clients, "cloudformation_client", lambda: cloudformation)
+    monkeypatch.setattr(cfg.clients, "ecs_client", lambda: ecs)
+
+    resources = cfg.Config.get_resources("benthic33k")
+    assert resources["ASG"] == "benthic33k-asg"
+    assert resources["VIDEO_QUEUE"] == "video-queue.fifo"
+    ecs.describe_task_definition.assert_called_once_with(taskDefinition="task-arn")
+
+
+def test_log_file_flushed_when_quiet(tmp_path):
+    import logging
+    import time
+    from deepsea_ai.logger import _TimedMemoryHandler
+
+    log_file = tmp_path / "deepsea_ai.log"
+    handler = _TimedMemoryHandler(capacity=32, flush_interval=0.05, flushLevel=logging.ERROR,
+                                  target=logging.FileHandler(log_file, mode="a", delay=True))
+    handler.handle(logging.makeLogRecord({"msg": "before long wait", "levelno": logging.INFO}))
+    assert not log_file.exists()
+    # the buffered record is written without waiting for another one
+    time.sleep(0.5)
+    assert "before long wait" in log_file.read_text()
+    handler.close()
+
+
+def test_script_processor_run_failed(monkeypatch):
+    from unittest import mock
+    import pytest
+    from deepsea_ai.aws.s3url import S3Url
+    from deepsea_ai.logger.job_cache import JobStatus
+
+    s3 = mock.Mock()
+    _, processor, cached = _stub_script_processor(monkeypatch, s3, status="Failed")
+    # sagemaker raises when a job it waits on fails
+    processor.run.side_effect = RuntimeError("Error for Processing job: Failed")
+    with pytest.raises(Exception, match="failed"):
+        _script_processor_run(S3Url("902005-video-in-dev", "M3/D"))
+    assert [args[3] for op, args in cached] == [JobStatus.RUNNING, JobStatus.FAIL]
+    s3.delete_object.assert_called_once()
@@ -28,6 +28,43 @@ def test_set_media():
     c.clear()
 
 
+def test_set_media_bulk():
+    c = JobCache(Path.cwd() / "tests" / "data" / "job_cache")
+    # write a fake job with a few fake videos
+    c.set_job("Dive1334", "yolov5-benthic33k", ["video1.mp4", "video2.mp4"], JobStatus.RUNNING)
+    # set the media in one write
+    c.set_media_bulk("Dive1334", ["video1.mp4", "video2.mp4"], JobStatus.SUCCESS)
+    # check that the media is there
+    assert c.get_media("video2.mp4", "Dive1334")[MediaIndex.STATUS] == JobStatus.SUCCESS
+    assert c.get_num_completed("Dive1334") == 2
+    # clean up
+    c.clear()
+
+
+def test_set_job_bulk():
+    c = JobCache(Path.cwd() / "tests" / "data" / "job_cache")
+    # the cache is a singleton
+    assert JobCache() is c
+    # write a fake job and its videos in one write
+    c.set_job_bulk("Dive1334", "yolov5-benthic33k", ["video1.mp4", "video2.mp4"], JobStatus.QUEUED)
+    assert c.get_all_media_names("Dive1334") == ["video1.mp4", "video2.mp4"]
+    assert c.get_media("video1.mp4", "Dive1334")[MediaIndex.STATUS] == JobStatus.QUEUED
+    # clean up
+    c.clear()
+
+
+def test_defer():
+    from deepsea_ai.logger import job_cache
+    c = JobCache(Path.cwd() / "tests" / "data" / "job_cache")
+    # queue a few writes and wait for the background writer
+    job_cache.defer('set_job_bulk', "Dive1334", "yolov5-benthic33k", ["video1.mp4"], JobStatus.QUEUED)
+    job_cache.defer('set_media', "Dive1334", "video1.mp4", JobStatus.SUCCESS)
+    job_cache.flush()
+    assert c.get_media("video1.mp4", "Dive1334")[MediaIndex.STATUS] == JobStatus.SUCCESS
+    # clean up
+    c.clear()
+
+
 def test_success_count():
     c = JobCache(Path.cwd() / "tests" / "data" / "job_cache")
     # write a fake job with a few fake videos